@@ -0,0 +1,241 @@
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from sys import argv
+
+from rasmus import treelib
+
+
+def _add_leaves(tree, nleaves, nspecies, nloci, rand):
+    """Returns nleaves new leaves of tree named species_locus_ind"""
+    nodes = []
+    for i in xrange(nleaves):
+        name = "s%d_%d_%d" % (rand.randrange(nspecies), rand.randrange(nloci), i)
+        nodes.append(tree.add(treelib.TreeNode(name)))
+    return nodes
+
+
+def random_tree(nleaves, nspecies=20, nloci=3, seed=0):
+    """Returns a random binary tree with leaves named species_locus_ind"""
+    rand = random.Random(seed)
+    tree = treelib.Tree()
+    nodes = _add_leaves(tree, nleaves, nspecies, nloci, rand)
+
+    # join random pairs of subtrees until one remains
+    while len(nodes) > 1:
+        i = rand.randrange(len(nodes))
+        nodes[i], nodes[-1] = nodes[-1], nodes[i]
+        child1 = nodes.pop()
+        i = rand.randrange(len(nodes))
+        child2 = nodes[i]
+        nodes[i] = tree.new_node()
+        tree.add_child(nodes[i], child1)
+        tree.add_child(nodes[i], child2)
+    tree.root = nodes[0]
+    return tree
+
+
+def balanced_tree(nleaves, nspecies=20, nloci=3, seed=0):
+    """Returns a balanced binary tree with leaves named species_locus_ind"""
+    tree = treelib.Tree()
+    nodes = _add_leaves(tree, nleaves, nspecies, nloci, random.Random(seed))
+
+    # join neighboring subtrees, one level at a time
+    while len(nodes) > 1:
+        level = []
+        for i in xrange(0, len(nodes) - 1, 2):
+            node = tree.new_node()
+            tree.add_child(node, nodes[i])
+            tree.add_child(node, nodes[i+1])
+            level.append(node)
+        if len(nodes) % 2:
+            level.append(nodes[-1])
+        nodes = level
+    tree.root = nodes[0]
+    return tree
+
+
+def caterpillar_tree(nleaves, nspecies=20, nloci=3, seed=0):
+    """Returns a caterpillar (each internal node has a leaf child) with
+    leaves named species_locus_ind"""
+    tree = treelib.Tree()
+    nodes = _add_leaves(tree, nleaves, nspecies, nloci, random.Random(seed))
+
+    node = nodes[0]
+    for leaf in nodes[1:]:
+        parent = tree.new_node()
+        tree.add_child(parent, node)
+        tree.add_child(parent, leaf)
+        node = parent
+    tree.root = node
+    return tree
+
+
+# tree shapes of the plct benchmark
+TREE_SHAPES = {"random": random_tree,
+               "balanced": balanced_tree,
+               "caterpillar": caterpillar_tree}
+
+
+def timeit(func, repeat=3):
+    """Returns the best time in seconds of 'repeat' calls to func"""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_load(tree_file, repeat=3):
+    """Compare loading a tree from newick and from a binary tree file"""
+    import bintreelib
+
+    fd, bin_file = tempfile.mkstemp(suffix=".tbin")
+    os.close(fd)
+    try:
+        bintreelib.newick2binary(tree_file, bin_file)
+        newick_time = timeit(lambda: treelib.read_newick(tree_file), repeat)
+        binary_time = timeit(lambda: bintreelib.read_binary_tree(bin_file),
+                             repeat)
+        print "read_newick:      %.6f s (%d bytes)" % (
+            newick_time, os.path.getsize(tree_file))
+        print "read_binary_tree: %.6f s (%d bytes)" % (
+            binary_time, os.path.getsize(bin_file))
+    finally:
+        os.remove(bin_file)
+
+
+def bench_batch(tree_file, repeat=3, mapping="sli_"):
+    """Compare checking each tree of a file with plctlib and a BatchContext"""
+    import batchlib
+    import plctlib
+
+    trees = list(treelib.iter_trees(tree_file))
+    single_time = timeit(lambda: [plctlib.is_reconcilable(tree, mapping)
+                                  for tree in trees], repeat)
+    context = batchlib.BatchContext(mapping)
+    batch_time = timeit(lambda: list(context.run(trees)), repeat)
+    print "is_reconcilable: %.6f s (%d trees)" % (single_time, len(trees))
+    print "BatchContext:    %.6f s (%d labels)" % (batch_time, len(context))
+
+
+def bench_plct(nleaves, repeat=3, nspecies=None, mapping="sli_",
+               backends=("python", "merge", "sparse")):
+    """Compare the plct backends on trees of each shape
+
+    nspecies -- number of species (default: one per 6 leaves, which gives
+                about 0.4 labels per leaf with 3 loci)
+    """
+    import plctlib
+
+    if nspecies is None:
+        nspecies = max(1, nleaves // 6)
+    for shape in sorted(TREE_SHAPES):
+        tree = TREE_SHAPES[shape](nleaves, nspecies)
+        groupings = plctlib.group_leaves(tree, mapping)
+        for backend in backends:
+            elapsed = timeit(lambda: plctlib.create_plct(
+                tree, groupings, backend=backend), repeat)
+            print "%-12s %-8s %.6f s (%d leaves, %d labels)" % (
+                shape, backend, elapsed, nleaves, len(groupings))
+
+
+def bench_parallel(nleaves, repeat=3, processes=(1, 2, 4), nspecies=None,
+                   mapping="sli_"):
+    """Compare plct_matrix in one process and split across worker processes
+
+    Scaling can only show when the machine has at least as many cpus as
+    processes, so the cpu count is printed with the times.
+    """
+    import multiprocessing
+    import plctlib
+
+    if nspecies is None:
+        nspecies = max(1, nleaves // 6)
+    print "cpus: %d" % multiprocessing.cpu_count()
+    for shape in sorted(TREE_SHAPES):
+        tree = TREE_SHAPES[shape](nleaves, nspecies)
+        groupings = plctlib.group_leaves(tree, mapping)
+        elapsed = timeit(lambda: plctlib.plct_matrix(tree, groupings), repeat)
+        print "%-12s serial      %.6f s (%d leaves, %d labels)" % (
+            shape, elapsed, nleaves, len(groupings))
+        for nprocs in processes:
+            elapsed = timeit(lambda: plctlib.plct_matrix(
+                tree, groupings, processes=nprocs), repeat)
+            print "%-12s processes=%d %.6f s" % (shape, nprocs, elapsed)
+
+
+# modules checked by the import benchmark
+IMPORT_MODULES = ["rasmus.treelib", "plctlib", "leglib", "multreelib",
+                  "MultTreeFeasTest", "multTreeLib"]
+
+# dependencies that should only load when the code using them runs
+HEAVY_MODULES = ["networkx", "Bio", "numpy", "scipy", "rasmus.textdraw"]
+
+# run in a fresh interpreter: prints import time and loaded heavy modules
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+print time.time() - start
+print " ".join(name for name in %r if name in sys.modules)
+"""
+
+
+def bench_imports(modules=IMPORT_MODULES, repeat=5):
+    """Time importing each module in a fresh interpreter
+
+    Also reports which heavy dependencies each import loads.  (python 2 has
+    no -X importtime, so imports are timed inside the child process.)
+    """
+    for module in modules:
+        best = None
+        for i in xrange(repeat):
+            output = subprocess.check_output(
+                [sys.executable, "-c", IMPORT_SCRIPT % (module, HEAVY_MODULES)],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed, heavy = (output.split("\n") + [""])[:2]
+            if best is None or float(elapsed) < best:
+                best = float(elapsed)
+        print "%-20s %.6f s  %s" % (module, best, heavy)
+
+
+def main(args):
+    if args[0] == "random":
+        # write a random tree to stdout
+        random_tree(int(args[1])).write(oneline=True)
+        print
+    elif args[0] == "load":
+        bench_load(args[1], *map(int, args[2:]))
+    elif args[0] == "batch":
+        bench_batch(args[1], *map(int, args[2:]))
+    elif args[0] == "plct":
+        bench_plct(*map(int, args[1:]))
+    elif args[0] == "parallel":
+        bench_parallel(int(args[1]), int(args[2]) if len(args) > 2 else 3,
+                       map(int, args[3:]) or (1, 2, 4))
+    elif args[0] == "imports":
+        if len(args) > 1:
+            bench_imports(args[1:])
+        else:
+            bench_imports()
+    else:
+        print "Unknown benchmark: " + args[0]
+
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print "Usage: MultTreeBench.py random <nleaves>"
+        print "       MultTreeBench.py load <tree_file> [repeat]"
+        print "       MultTreeBench.py batch <tree_file> [repeat]"
+        print "       MultTreeBench.py plct <nleaves> [repeat] [nspecies]"
+        print "       MultTreeBench.py parallel <nleaves> [repeat] [processes ...]"
+        print "       MultTreeBench.py imports [module ...]"
+    else:
+        main(argv[1:])
@@ -0,0 +1,481 @@
+# Local feasibility service
+#
+# A long-lived server that checks the feasibility of trees (and optionally
+# binarizes them) in a pool of warm worker processes, so callers do not pay
+# for a new python process and its imports per tree.
+#
+# Protocol: clients connect to a unix socket (or a TCP port) and send one
+# JSON request per line:
+#
+#   {"id": 1, "newick": "((a_1_1,b_1_2),a_2_3);", "op": "feasible",
+#    "mapping": "sli_", "timeout": 10}
+#
+# op is "feasible" (default), "binarize" or "stats".  Each request gets one
+# JSON response line with the same id and either "feasible" (plus "newick"
+# for binarize) or "error".  Small requests are batched together.
+# When too many requests are pending the server answers "busy" right away
+# instead of queueing more work.
+#
+# Each worker process has its own pipe and works on one batch at a time.  A
+# collector thread reads the responses.  When a batch outlives the deadlines
+# of all its requests, or its worker dies, the worker is replaced by a new
+# one: overrun batches are answered "timeout" and the batch of a dead worker
+# is sent to the new worker (once).
+import collections
+import json
+import multiprocessing
+import os
+import Queue
+import select
+import signal
+import SocketServer
+import socket
+import threading
+import time
+from StringIO import StringIO
+from sys import argv
+
+
+# defaults
+BATCH_SIZE = 32          # max requests per batch
+BATCH_WAIT = 0.005       # seconds to wait for a batch to fill
+MAX_PENDING = 1024       # max queued requests before answering "busy"
+TIMEOUT = 60.0           # default per-request timeout in seconds
+LATENCY_WINDOW = 10000   # number of recent latencies kept for statistics
+WATCH_INTERVAL = 0.05    # seconds between checks of the busy workers
+MAX_RETRIES = 1          # times a batch is resent after losing a worker
+
+
+#=============================================================================
+# workers
+
+def _init_worker():
+    """Import the tree libraries once per worker process"""
+    global multreelib, treelib
+    # leave Ctrl-C to the server, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import multreelib
+    from rasmus import treelib
+
+
+def _serve(conn):
+    """Worker: answer the batches sent on a pipe"""
+    _init_worker()
+    while True:
+        try:
+            requests = conn.recv()
+        except EOFError:
+            return
+        conn.send(_run_batch(requests))
+
+
+def _run_batch(requests):
+    """Worker: returns a response for each request of a batch"""
+    return [_run(request) for request in requests]
+
+
+def _run(request):
+    """Worker: check the feasibility of one tree (and binarize it)"""
+    try:
+        tree = multreelib.Tree(StringIO(request["newick"]),
+                               mapping=request.get("mapping", "sli_"),
+                               leg_mode="components")
+        response = {"feasible": tree.is_feasible()}
+        if request.get("op") == "binarize":
+            if tree.is_multifurcating():
+                tree.binarize()
+            # drop the handle added above the root
+            root = tree.tree.root.children[0]
+            response["newick"] = treelib.subtree(
+                tree.tree, root).get_one_line_newick()
+    except Exception, e:
+        response = {"error": "%s: %s" % (type(e).__name__, e)}
+    return response
+
+
+#=============================================================================
+# server
+
+class Stats(object):
+    """Thread-safe throughput and latency statistics"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counts = collections.defaultdict(int)
+        self.latencies = collections.deque(maxlen=window)
+
+    def count(self, key, latency=None):
+        with self.lock:
+            self.counts[key] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def report(self):
+        """Returns a dict of counts, throughput and latency percentiles"""
+        with self.lock:
+            report = dict(self.counts)
+            latencies = sorted(self.latencies)
+        uptime = time.time() - self.start
+        report["uptime"] = uptime
+        report["throughput"] = report.get("completed", 0) / max(uptime, 1e-9)
+        if latencies:
+            report["latency_mean"] = sum(latencies) / len(latencies)
+            for p in (50, 95, 99):
+                i = min(len(latencies) - 1, len(latencies) * p // 100)
+                report["latency_p%d" % p] = latencies[i]
+        return report
+
+
+class Pending(object):
+    """A request waiting for its response"""
+
+    def __init__(self, request, timeout):
+        self.request = request
+        self.start = time.time()
+        self.deadline = self.start + timeout
+        self.response = None
+        self.done = threading.Event()
+
+    def finish(self, response):
+        self.response = response
+        self.done.set()
+
+
+class Batch(object):
+    """Requests sent to a worker together"""
+
+    def __init__(self, pending):
+        self.pending = pending
+        self.deadline = max(item.deadline for item in pending)
+        self.tries = 0
+
+    def finish(self, responses):
+        for pending, response in zip(self.pending, responses):
+            pending.finish(response)
+
+
+class Worker(object):
+    """A worker process and the batch it is working on"""
+
+    def __init__(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child,))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.batch = None
+
+    def send(self, batch):
+        batch.tries += 1
+        self.batch = batch
+        self.conn.send([pending.request for pending in batch.pending])
+
+    def stop(self):
+        """Stop the process, even if it is busy"""
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+
+def _request_timeout(request, default):
+    """Returns the timeout of a request, or None if the request is not a
+    dict or its timeout is not a positive number"""
+    if not isinstance(request, dict):
+        return None
+    timeout = request.get("timeout", default)
+    if (isinstance(timeout, bool) or
+            not isinstance(timeout, (int, long, float))):
+        return None
+    timeout = float(timeout)
+    if not 0 < timeout < float("inf"):
+        return None
+    return timeout
+
+
+class FeasibilityService(object):
+    """Batches requests into warm worker processes
+
+    processes   -- number of worker processes (default: number of cpus)
+    batch_size  -- max requests per batch
+    batch_wait  -- seconds to wait for more requests before sending a batch
+    max_pending -- max queued requests; more are rejected as "busy"
+    timeout     -- default per-request timeout in seconds
+    """
+
+    def __init__(self, processes=None, batch_size=BATCH_SIZE,
+                 batch_wait=BATCH_WAIT, max_pending=MAX_PENDING,
+                 timeout=TIMEOUT):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.stats = Stats()
+        self.queue = Queue.Queue(max_pending)
+
+        # one batch per worker; the rest wait in the queue, which bounds
+        # memory and makes the queue fill under load.  The workers and their
+        # batches are guarded by the lock: the dispatcher hands batches to
+        # idle workers, and the collector takes the responses back
+        self.lock = threading.Condition()
+        self.workers = [Worker() for i in xrange(processes)]
+
+        self.running = True
+        self.collecting = True
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def submit(self, request):
+        """Returns the response to a request, blocking until it is ready"""
+        timeout = _request_timeout(request, self.timeout)
+        if timeout is None:
+            self.stats.count("errors")
+            return {"error": "invalid request"}
+        if request.get("op") == "stats":
+            return self.stats.report()
+        if "newick" not in request:
+            self.stats.count("errors")
+            return {"error": "missing newick"}
+
+        pending = Pending(request, timeout)
+        try:
+            self.queue.put_nowait(pending)
+        except Queue.Full:
+            self.stats.count("rejected")
+            return {"error": "busy"}
+
+        if not pending.done.wait(max(pending.deadline - time.time(), 0)):
+            self.stats.count("timeouts")
+            return {"error": "timeout"}
+
+        response = pending.response
+        if "error" in response:
+            self.stats.count("errors")
+        else:
+            self.stats.count("completed", time.time() - pending.start)
+        return response
+
+    def _dispatch(self):
+        """Collect queued requests into batches and send them to idle workers"""
+        while self.running:
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except Queue.Empty:
+                continue
+            end = time.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(end - time.time(), 0)))
+                except Queue.Empty:
+                    break
+
+            # skip requests whose callers have already given up
+            now = time.time()
+            batch = [pending for pending in batch if pending.deadline > now]
+            if not batch:
+                continue
+
+            self.stats.count("batches")
+            with self.lock:
+                while True:
+                    idle = [worker for worker in self.workers
+                            if worker.batch is None]
+                    if idle:
+                        break
+                    self.lock.wait()
+                idle[0].send(Batch(batch))
+
+    def _collect(self):
+        """Hand responses back to the waiting requests, and replace workers
+        that overrun or die"""
+        while self.collecting:
+            # only the collector replaces workers, so the list is stable here
+            workers = list(self.workers)
+            ready = select.select([worker.conn for worker in workers],
+                                  [], [], WATCH_INTERVAL)[0]
+
+            now = time.time()
+            finished = []
+            with self.lock:
+                for worker in workers:
+                    batch = worker.batch
+                    if worker.conn in ready:
+                        try:
+                            responses = worker.conn.recv()
+                        except EOFError:
+                            pass
+                        else:
+                            worker.batch = None
+                            finished.append((batch, responses))
+                            continue
+                    elif worker.process.is_alive() and (
+                            batch is None or batch.deadline > now):
+                        continue
+
+                    # the worker is gone (its pipe closed or it exited), or
+                    # stuck on an overrun batch
+                    lost = worker.conn in ready or not worker.process.is_alive()
+                    error = self._restart(worker, lost)
+                    if error is not None:
+                        finished.append((batch,
+                                         [{"error": error}] * len(batch.pending)))
+                self.lock.notify_all()
+
+            for batch, responses in finished:
+                batch.finish(responses)
+
+    def _restart(self, worker, lost):
+        """Replace a stuck or dead worker (the lock is held)
+
+        Its batch is resent to the new worker unless it has overrun or been
+        tried too often.  Returns the error to answer it with otherwise.
+        """
+        batch = worker.batch
+        if lost:
+            self.stats.count("workers_lost")
+        else:
+            self.stats.count("overruns")
+        self.stats.count("restarts")
+
+        worker.stop()
+        replacement = Worker()
+        self.workers[self.workers.index(worker)] = replacement
+
+        if batch is None:
+            return None
+        elif batch.deadline <= time.time():
+            return "timeout"
+        elif batch.tries > MAX_RETRIES:
+            return "worker lost"
+        replacement.send(batch)
+        return None
+
+    def close(self):
+        self.running = False
+        self.dispatcher.join()
+        # the collector keeps enforcing deadlines until the last batches finish
+        while any(worker.batch is not None for worker in self.workers):
+            time.sleep(WATCH_INTERVAL)
+        self.collecting = False
+        self.collector.join()
+        for worker in self.workers:
+            worker.stop()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """Answers one JSON request per line on a connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError:
+                request = None
+            if isinstance(request, dict):
+                response = self.server.service.submit(request)
+                response["id"] = request.get("id")
+            else:
+                response = {"error": "invalid request"}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, service):
+    """Returns a threaded server for a socket path or a (host, port) pair"""
+    if isinstance(address, basestring):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, RequestHandler)
+    else:
+        server = TCPServer(address, RequestHandler)
+    server.service = service
+    return server
+
+
+#=============================================================================
+# client
+
+class Client(object):
+    """A connection to a feasibility service"""
+
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+        self.stream = self.sock.makefile("r+b")
+        self.nextid = 0
+
+    def request(self, request):
+        """Send a request dict and return its response"""
+        request.setdefault("id", self.nextid)
+        self.nextid += 1
+        self.stream.write(json.dumps(request) + "\n")
+        self.stream.flush()
+        return json.loads(self.stream.readline())
+
+    def is_feasible(self, newick, mapping="sli_"):
+        return self.request({"newick": newick, "mapping": mapping})
+
+    def binarize(self, newick, mapping="sli_"):
+        return self.request({"newick": newick, "mapping": mapping,
+                             "op": "binarize"})
+
+    def get_stats(self):
+        return self.request({"op": "stats"})
+
+    def close(self):
+        self.stream.close()
+        self.sock.close()
+
+
+def parse_address(text):
+    """Returns a socket path or (host, port) from 'path' or 'host:port'"""
+    if ":" in text:
+        host, port = text.rsplit(":", 1)
+        return (host, int(port))
+    return text
+
+
+def main(address, processes=None):
+    service = FeasibilityService(processes)
+    server = make_server(parse_address(address), service)
+    print "Serving on " + address
+
+    # shut down cleanly on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        print json.dumps(service.stats.report(), indent=2)
+
+
+if __name__ == '__main__':
+    if len(argv) < 2:
+        print "Usage: MultTreeServer.py <socket_path|host:port> [processes]"
+    else:
+        main(argv[1], *map(int, argv[2:]))
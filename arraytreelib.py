@@ -0,0 +1,305 @@
+# Array-backed trees
+#
+# A compact, read-only view of a rasmus treelib.Tree.  Nodes are stored in
+# postorder, so the subtree of node i is the contiguous index range
+# starts[i]..i.  Per-subtree quantities (such as the number of leaves of each
+# label beneath a node) can then be computed with cumulative sums instead of
+# recursing over the tree.
+import array
+
+import numpy as np
+from scipy import sparse
+
+from rasmus import treelib
+
+
+# upper bound on the number of cells in a dense block of subtree counts
+MAX_BLOCK_CELLS = 1 << 24
+
+
+class ArrayTree(object):
+    """A tree stored as parallel arrays in postorder
+
+    parents -- index of the parent of each node (-1 for the root)
+    starts  -- index of the first node in the subtree of each node
+    dists   -- branch length above each node
+    names   -- node names
+    nodes   -- TreeNode each row was built from (None if there is no Tree)
+    """
+
+    def __init__(self, parents, starts, dists, names, nodes=None):
+        self.parents = parents
+        self.starts = starts
+        self.dists = dists
+        self.names = names
+        self.nodes = nodes
+
+    def __len__(self):
+        """Returns number of nodes in tree"""
+        return len(self.parents)
+
+    def __repr__(self):
+        return "<array tree with %d nodes>" % len(self)
+
+    def root(self):
+        """Returns the index of the root"""
+        return len(self) - 1
+
+    def is_leaf(self):
+        """Returns a boolean mask of the leaves"""
+        return self.starts == np.arange(len(self))
+
+    def leaves(self):
+        """Returns the indices of the leaves in traversal order"""
+        return np.flatnonzero(self.is_leaf())
+
+    def sizes(self):
+        """Returns the number of nodes in the subtree of each node"""
+        return np.arange(1, len(self) + 1) - self.starts
+
+
+def from_tree(tree, node=None):
+    """Returns an ArrayTree for the subtree of 'tree' rooted at 'node'"""
+
+    if node is None:
+        node = tree.root
+
+    nodes = list(tree.postorder(node))
+    lookup = dict((n, i) for i, n in enumerate(nodes))
+    nnodes = len(nodes)
+
+    parents = np.empty(nnodes, dtype=np.int64)
+    starts = np.arange(nnodes, dtype=np.int64)
+    dists = np.empty(nnodes, dtype=np.float64)
+    for i, n in enumerate(nodes):
+        dists[i] = n.dist
+        if n is node:
+            parents[i] = -1
+        else:
+            parent = lookup[n.parent]
+            parents[i] = parent
+            # the first child visited holds the smallest start
+            if starts[i] < starts[parent]:
+                starts[parent] = starts[i]
+
+    return ArrayTree(parents, starts, dists, [n.name for n in nodes], nodes)
+
+
+def to_tree(atree):
+    """Returns a new treelib.Tree with the structure of 'atree'"""
+
+    tree = treelib.Tree()
+    nodes = [treelib.TreeNode(name) for name in atree.names]
+
+    for i, node in enumerate(nodes):
+        node.dist = float(atree.dists[i])
+        parent = atree.parents[i]
+        if parent == -1:
+            tree.root = node
+            tree.add(node)
+        else:
+            # postorder visits children in order, before their parent
+            tree.add_child(nodes[parent], node)
+
+    names = [name for name in atree.names if isinstance(name, int)]
+    if names:
+        tree.nextname = max(names) + 1
+
+    return tree
+
+
+#=============================================================================
+# subtree counts
+
+def name_ids(atree, lookup):
+    """Returns an array of the ids of each node name (-1 if not in 'lookup')"""
+    return np.array([lookup.get(name, -1) for name in atree.names],
+                    dtype=np.int64)
+
+
+def count_matrix(atree, ids, nids):
+    """Returns a sparse (nodes x ids) matrix of id occurrences
+
+    ids -- id of each node in 'atree' (-1 for nodes without an id)
+    """
+    rows = np.flatnonzero(ids >= 0)
+    return sparse.csc_matrix(
+        (np.ones(len(rows), dtype=np.int64), (rows, ids[rows])),
+        shape=(len(atree), nids))
+
+
+def iter_subtree_counts(atree, ids, nids, max_cells=MAX_BLOCK_CELLS):
+    """Iterates over blocks of per-subtree id counts
+
+    Yields (cols, counts) where counts[i, j] is the number of nodes beneath
+    (and including) node i with id cols[j].  Columns are processed in blocks
+    of at most 'max_cells' dense cells, so this costs O(nodes x ids) however
+    sparse the counts are (partial_count_matrix does not use it).
+    """
+
+    nnodes = len(atree)
+    mat = count_matrix(atree, ids, nids)
+    stops = np.arange(1, nnodes + 1)
+    blocksize = max(1, max_cells // (nnodes + 1))
+
+    for start in xrange(0, nids, blocksize):
+        cols = np.arange(start, min(start + blocksize, nids))
+
+        # cumulative counts over postorder positions; the subtree of node i
+        # occupies positions starts[i]..i
+        cumsum = np.zeros((nnodes + 1, len(cols)), dtype=np.int64)
+        cumsum[1:] = mat[:, cols].toarray()
+        np.cumsum(cumsum, axis=0, out=cumsum)
+
+        yield cols, cumsum[stops] - cumsum[atree.starts]
+
+
+def partial_count_matrix(atree, ids, nids, totals=None):
+    """Returns a sparse boolean (nodes x ids) matrix
+
+    Entry (i, j) is True if the subtree of node i contains some, but not all,
+    of the nodes with id j.  By default the totals of each id are counted
+    in 'atree', but they can also be given (e.g. for a subtree of a larger
+    tree).
+
+    These are the nodes on the paths from the nodes with id j up to their
+    lca (excluding it), or up to the root if the tree holds fewer than the
+    total (see path_matrix).
+    """
+    counts = np.bincount(ids[ids >= 0], minlength=nids)
+    if totals is None:
+        totals = counts
+
+    # nodes of each id, in postorder
+    order = np.argsort(ids, kind="mergesort")
+    order = order[len(ids) - counts.sum():]
+    return path_matrix(atree, order, ids[order], nids, counts < totals)
+
+
+def path_matrix(atree, nodes, ids, nids, partial=None, format="csr"):
+    """Returns a sparse boolean (nodes x ids) matrix of the paths from the
+    given nodes of each id up to their lca (excluding it)
+
+    nodes, ids -- arrays of node indices and their ids, sorted by id and
+                  then by node
+    partial    -- boolean array, True for ids whose paths go up to the root
+                  (including it) instead
+    format     -- scipy sparse format of the matrix
+
+    Taking the nodes in postorder, the path from each node only goes up to
+    its lca with the previous one, so the paths do not overlap.  With a heavy
+    path decomposition each path is a few ranges of nodes, so the python work
+    is O(log n) per node, and the entries are filled in by numpy.
+    """
+    counts = np.bincount(ids, minlength=nids)
+    order = np.asarray(nodes).tolist()
+    ends = np.cumsum(counts).tolist()
+    if partial is None:
+        partial = [False] * nids
+    else:
+        partial = np.asarray(partial).tolist()
+
+    parents = atree.parents.tolist()
+    path_nodes, pos, head, depth = _heavy_paths(parents, atree.starts)
+
+    def lca(u, v):
+        while head[u] != head[v]:
+            if depth[head[u]] > depth[head[v]]:
+                u = parents[head[u]]
+            else:
+                v = parents[head[v]]
+        return u if depth[u] < depth[v] else v
+
+    # ranges of path positions (inclusive) of each id
+    lows = array.array("l")
+    highs = array.array("l")
+    cols = array.array("l")
+    begin = 0
+    for j, end in enumerate(ends):
+        nodes = order[begin:end]
+        begin = end
+        if not nodes or (len(nodes) < 2 and not partial[j]):
+            continue
+
+        # (node, stop) paths, up to but excluding stop (-1 past the root)
+        top = -1 if partial[j] else lca(nodes[0], nodes[-1])
+        paths = [(nodes[0], top)]
+        for i in xrange(1, len(nodes)):
+            paths.append((nodes[i], lca(nodes[i-1], nodes[i])))
+
+        for u, stop in paths:
+            while u != stop:
+                if stop != -1 and head[u] == head[stop]:
+                    lows.append(pos[stop] + 1)
+                    highs.append(pos[u])
+                    cols.append(j)
+                    break
+                lows.append(pos[head[u]])
+                highs.append(pos[u])
+                cols.append(j)
+                u = parents[head[u]]
+
+    lows = _as_array(lows)
+    lengths = _as_array(highs) - lows + 1
+    keep = lengths > 0
+    lows, lengths, cols = lows[keep], lengths[keep], _as_array(cols)[keep]
+
+    # expand the ranges, which are grouped by id: the columns of a csc matrix
+    nnz = int(lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    index = np.arange(nnz, dtype=np.int64)
+    index -= np.repeat(offsets - lows, lengths)
+    rows = np.asarray(path_nodes, dtype=np.int32)[index]
+    indptr = np.zeros(nids + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cols, lengths, nids).astype(np.int64),
+              out=indptr[1:])
+    presence = sparse.csc_matrix((np.ones(nnz, dtype=bool), rows, indptr),
+                                 shape=(len(atree), nids))
+    return presence.asformat(format)
+
+
+def _heavy_paths(parents, starts):
+    """Returns (nodes, pos, head, depth) of a heavy path decomposition
+
+    nodes -- nodes listed path by path, each path from its top down
+    pos   -- index of each node in nodes
+    head  -- top node of the path of each node
+    depth -- depth of each node
+
+    parents is a list, starts an array, of a tree in postorder.
+    """
+    nnodes = len(parents)
+    sizes = (np.arange(1, nnodes + 1) - starts).tolist()
+
+    heavy = [-1] * nnodes
+    for i in xrange(nnodes - 1):
+        parent = parents[i]
+        if parent != -1 and (heavy[parent] == -1 or
+                             sizes[i] > sizes[heavy[parent]]):
+            heavy[parent] = i
+
+    # parents come after their children in postorder
+    head = range(nnodes)
+    depth = [0] * nnodes
+    for i in xrange(nnodes - 1, -1, -1):
+        parent = parents[i]
+        if parent != -1:
+            depth[i] = depth[parent] + 1
+            if heavy[parent] == i:
+                head[i] = head[parent]
+
+    nodes = []
+    pos = [0] * nnodes
+    for i in xrange(nnodes - 1, -1, -1):
+        if head[i] == i:
+            node = i
+            while node != -1:
+                pos[node] = len(nodes)
+                nodes.append(node)
+                node = heavy[node]
+    return nodes, pos, head, depth
+
+
+def _as_array(buf):
+    """Returns an int64 array of an array.array"""
+    return np.array(buf, dtype=np.int64) if buf else np.zeros(0, np.int64)
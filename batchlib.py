@@ -0,0 +1,269 @@
+# Batch feasibility for tree collections
+#
+# Trees of one gene family collection share their species and loci, so a
+# BatchContext interns each label (and each leaf name) once and keeps its
+# buffers between trees:
+#
+#   per node  -- parent, first node of the subtree, leaf label, and the
+#                last walk through the branch and its first label
+#   per label -- leaf count, first and last leaf, and a union-find parent
+#
+# A tree is loaded into the node buffers, a treelib.Tree in preorder and an
+# arraytreelib.ArrayTree in its own postorder.  Either way the subtree of
+# node v starts at node lo[v].  Each label is walked up from its leaves to
+# their lca, as in plctlib.create_plct, and the first label to reach a
+# branch owns it: later labels on that branch are joined to it in the
+# union-find.  Entries are stamped with a tree (or walk) serial number, so
+# buffers never need to be cleared.
+import multreelib
+
+
+class BatchContext(object):
+    """Checks the feasibility of many trees with a shared label vocabulary
+
+    mapping -- leaf name format (see multreelib.parse_gene)
+    """
+
+    def __init__(self, mapping='sli_'):
+        self.mapping = mapping
+
+        # interned labels
+        self.labels = []       # id -> (species, locus)
+        self.label_ids = {}    # (species, locus) -> id
+        self.species = []      # id -> species of label
+        self.name_ids = {}     # leaf name -> label id
+
+        # node buffers
+        self._parent = []
+        self._lo = []
+        self._leaf = []        # label id of each leaf (-1 for internal nodes)
+        self._next = []        # next leaf with the same label
+        self._walk = []        # serial of the last walk through the branch
+        self._owner = []       # first label on the branch in this tree
+        self._owned = []       # tree serial of the owner
+
+        # label buffers
+        self._count = []
+        self._first = []
+        self._last = []
+        self._union = []
+        self._seen = []        # tree serial of the label
+        self._touched = []     # labels of the current tree
+        self._loci = {}        # (component, species) -> locus
+
+        self._serial = 0
+        self._walks = 0
+
+    def __len__(self):
+        """Returns the number of interned labels"""
+        return len(self.labels)
+
+    def label_id(self, name):
+        """Returns the label id of a leaf name, interning it if needed"""
+        lid = self.name_ids.get(name)
+        if lid is None:
+            species, locus, ind = multreelib.parse_gene(name, self.mapping)
+            label = (species, locus)
+            lid = self.label_ids.get(label)
+            if lid is None:
+                lid = len(self.labels)
+                self.label_ids[label] = lid
+                self.labels.append(label)
+                self.species.append(species)
+                for buf in (self._count, self._first, self._last,
+                            self._union, self._seen):
+                    buf.append(0)
+            self.name_ids[name] = lid
+        return lid
+
+    #=========================================================================
+    # feasibility
+
+    def is_feasible(self, tree):
+        """Returns True if tree (a treelib.Tree or ArrayTree) is feasible"""
+        self._components(tree)
+        return self._is_feasible()
+
+    def get_conflicts(self, tree):
+        """Returns the conflicting components of tree (as in
+        plctlib.get_conflicts)"""
+        self._components(tree)
+        find = self._find
+        ccs = {}
+        for lid in self._touched:
+            ccs.setdefault(find(lid), []).append(lid)
+
+        conflicts = set()
+        for cc in ccs.itervalues():
+            loci = {}
+            for lid in cc:
+                species, locus = self.labels[lid]
+                if loci.setdefault(species, locus) != locus:
+                    conflicts.add(tuple(self.labels[lid] for lid in cc))
+                    break
+        return conflicts
+
+    def run(self, trees, dedup=False):
+        """Iterate through the feasibility of each tree
+
+        dedup -- check each topology once (see canonlib), trees repeating an
+                 earlier topology reuse its result
+        """
+        if dedup:
+            import canonlib
+
+        seen = {}  # canonical hash -> feasibility
+        for tree in trees:
+            key = canonlib.canonical_hash(tree) if dedup else None
+            feasible = seen.get(key)
+            if feasible is None:
+                self._components(tree)
+                feasible = self._is_feasible()
+                if dedup:
+                    seen[key] = feasible
+            yield feasible
+
+    def _is_feasible(self):
+        """Returns True if no component of the current tree has two loci of a
+        species"""
+        find = self._find
+        species = self.species
+        labels = self.labels
+        loci = self._loci
+        loci.clear()
+        for lid in self._touched:
+            locus = labels[lid][1]
+            if loci.setdefault((find(lid), species[lid]), locus) != locus:
+                return False
+        return True
+
+    def _find(self, lid):
+        """Returns the union-find root of a label"""
+        union = self._union
+        root = lid
+        while union[root] != root:
+            root = union[root]
+        while union[lid] != root:
+            union[lid], lid = root, union[lid]
+        return root
+
+    #=========================================================================
+    # trees
+
+    def _components(self, tree):
+        """Join the labels of tree that share a branch in the union-find"""
+        self._serial += 1
+        serial = self._serial
+        nnodes = self._load(tree)
+
+        # group the leaves by label
+        parent, lo = self._parent, self._lo
+        leaf, nxt = self._leaf, self._next
+        count, first, last = self._count, self._first, self._last
+        union, seen = self._union, self._seen
+        touched = self._touched
+        del touched[:]
+        for v in xrange(nnodes):
+            lid = leaf[v]
+            if lid < 0:
+                continue
+            if seen[lid] != serial:
+                seen[lid] = serial
+                touched.append(lid)
+                union[lid] = lid
+                count[lid] = 0
+                first[lid] = v
+                nxt[v] = -1
+            else:
+                nxt[v] = nxt[first[lid]]
+                nxt[first[lid]] = v
+            count[lid] += 1
+            last[lid] = v
+
+        # walk each label from its leaves to their lca
+        walk, owner, owned = self._walk, self._owner, self._owned
+        find = self._find
+        for lid in touched:
+            if count[lid] < 2:
+                continue
+            self._walks += 1
+            stamp = self._walks
+
+            # the lca is the first ancestor of the last leaf whose subtree
+            # starts at or before the first leaf
+            lca = last[lid]
+            low = first[lid]
+            while lo[lca] > low:
+                lca = parent[lca]
+
+            v = first[lid]
+            while v != -1:
+                u = v
+                while u != lca and walk[u] != stamp:
+                    walk[u] = stamp
+                    if owned[u] != serial:
+                        owned[u] = serial
+                        owner[u] = lid
+                    else:
+                        root1, root2 = find(owner[u]), find(lid)
+                        if root1 != root2:
+                            union[root2] = root1
+                    u = parent[u]
+                v = nxt[v]
+
+        return nnodes
+
+    def _load(self, tree):
+        """Fill the node buffers with tree, returns its number of nodes"""
+        # ArrayTrees have subtree starts (checked without importing numpy)
+        if hasattr(tree, "starts"):
+            return self._load_array_tree(tree)
+
+        nnodes = len(tree.nodes)
+        self._reserve(nnodes)
+        parent, lo, leaf = self._parent, self._lo, self._leaf
+        label_id = self.label_id
+
+        # preorder: the subtree of v starts at v
+        i = 0
+        stack = [(tree.root, -1)]
+        while stack:
+            node, up = stack.pop()
+            parent[i] = up
+            lo[i] = i
+            if node.children:
+                leaf[i] = -1
+                for child in reversed(node.children):
+                    stack.append((child, i))
+            else:
+                leaf[i] = label_id(node.name)
+            i += 1
+        return i
+
+    def _load_array_tree(self, atree):
+        """Fill the node buffers with an ArrayTree (in postorder)"""
+        nnodes = len(atree)
+        self._reserve(nnodes)
+        self._parent[:nnodes] = atree.parents.tolist()
+        self._lo[:nnodes] = atree.starts.tolist()
+
+        leaf, lo, label_id = self._leaf, self._lo, self.label_id
+        names = atree.names
+        for v in xrange(nnodes):
+            leaf[v] = label_id(names[v]) if lo[v] == v else -1
+        return nnodes
+
+    def _reserve(self, nnodes):
+        """Grow the node buffers to hold at least nnodes"""
+        size = len(self._parent)
+        if size >= nnodes:
+            return
+        grow = max(nnodes, 2 * size) - size
+        for buf in (self._parent, self._lo, self._leaf,
+                    self._next, self._walk, self._owner, self._owned):
+            buf.extend([0] * grow)
+
+
+def is_feasible_all(trees, mapping='sli_', dedup=False):
+    """Returns a list of the feasibility of each tree in a collection"""
+    return list(BatchContext(mapping).run(trees, dedup))
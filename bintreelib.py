@@ -0,0 +1,135 @@
+# Binary tree files
+#
+# A compact on-disk format for trees that are read many times.  A tree is
+# stored as a blob:
+#
+#   header  -- magic, format version, header length (struct "<4sII")
+#   fields  -- JSON list of (name, dtype, shape, offset) for each array,
+#              padded to an 8 byte boundary
+#   data    -- parent index, subtree start and dist arrays followed by an
+#              interned name table (see sharedtreelib.tree_arrays)
+#
+# Offsets are relative to the end of the header, so blobs can be embedded in
+# larger files.  Loading memory-maps the file and returns an
+# arraytreelib.ArrayTree view without parsing each node.
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from rasmus import treelib
+from rasmus import util
+import arraytreelib
+import sharedtreelib
+
+
+MAGIC = "MTRB"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+
+
+def pack_tree(atree, **extra):
+    """Returns a binary blob (string) for an ArrayTree and any extra arrays"""
+    arrays = sharedtreelib.tree_arrays(atree)
+    for name, array in extra.iteritems():
+        assert name not in arrays, name
+        arrays[name] = array
+    return pack_arrays(arrays)
+
+
+def pack_arrays(arrays):
+    """Returns a binary blob (string) for a dict of arrays"""
+    arrays = dict((name, np.asarray(array))
+                  for name, array in arrays.iteritems())
+    fields, size = sharedtreelib.layout_arrays(arrays)
+
+    text = json.dumps(fields)
+    headlen = HEADER.size + len(text)
+    headlen += -headlen % sharedtreelib.ALIGN
+    text = text.ljust(headlen - HEADER.size)
+
+    chunks = [HEADER.pack(MAGIC, VERSION, headlen), text]
+    pos = 0
+    for name, dtype, shape, offset in fields:
+        chunks.append("\0" * (offset - pos))
+        data = np.ascontiguousarray(arrays[name]).tostring()
+        chunks.append(data)
+        pos = offset + len(data)
+    chunks.append("\0" * (size - pos))
+
+    return "".join(chunks)
+
+
+def unpack_arrays(buf, offset=0):
+    """Returns a dict of array views of the blob at 'offset' in 'buf'"""
+    magic, version, headlen = HEADER.unpack_from(buf, offset)
+    if magic != MAGIC:
+        raise Exception("not a binary tree blob")
+    if version != VERSION:
+        raise Exception("binary tree version not supported: %d" % version)
+
+    text = buf[offset + HEADER.size:offset + headlen]
+    fields = [(name, dtype, tuple(shape), pos)
+              for name, dtype, shape, pos in json.loads(text)]
+    return sharedtreelib.map_arrays(buf, fields, offset + headlen)
+
+
+def unpack_tree(buf, offset=0):
+    """Returns an ArrayTree view of the blob at 'offset' in 'buf'"""
+    return sharedtreelib.array_tree(unpack_arrays(buf, offset))
+
+
+def blob_size(buf, offset=0):
+    """Returns the size in bytes of the blob at 'offset' in 'buf'"""
+    magic, version, headlen = HEADER.unpack_from(buf, offset)
+    text = buf[offset + HEADER.size:offset + headlen]
+    size = 0
+    for name, dtype, shape, pos in json.loads(text):
+        size = max(size, pos + np.dtype(dtype).itemsize * int(np.prod(shape)))
+    return headlen + size + (-size % sharedtreelib.ALIGN)
+
+
+#=============================================================================
+# files
+
+def open_output(filename):
+    """Returns a stream for writing a memory-mapped file format
+
+    Files are opened as is: util.open_stream would compress names ending
+    in .gz, .bz2 or .zst, which can not be mapped when read back.
+    """
+    if isinstance(filename, basestring) and filename != "-":
+        return open(filename, "wb")
+    return util.open_stream(filename, "wb")
+
+
+def write_binary_tree(tree, filename):
+    """Write a treelib.Tree or ArrayTree to a binary tree file"""
+    if not isinstance(tree, arraytreelib.ArrayTree):
+        tree = arraytreelib.from_tree(tree)
+    out = open_output(filename)
+    out.write(pack_tree(tree))
+    out.close()
+
+
+def map_file(filename):
+    """Returns a read-only memory map of a file"""
+    with open(filename, "rb") as infile:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_binary_tree(filename):
+    """Returns an ArrayTree view of a memory-mapped binary tree file"""
+    return unpack_tree(map_file(filename))
+
+
+def newick2binary(infile, outfile):
+    """Convert a newick tree file to a binary tree file"""
+    write_binary_tree(treelib.read_newick(infile), outfile)
+
+
+def binary2newick(infile, out, oneline=False):
+    """Convert a binary tree file to a newick tree file"""
+    tree = arraytreelib.to_tree(read_binary_tree(infile))
+    tree.write(out, oneline=oneline)
@@ -0,0 +1,88 @@
+# Canonical tree forms
+#
+# Two trees have the same topology if they differ only in the order of
+# children, the names of internal nodes and branch lengths.  The canonical
+# newick of a tree orders the children of each node by the smallest leaf name
+# beneath them and leaves out internal names and lengths, so trees with the
+# same topology (and leaf names) have the same canonical newick and hash.
+#
+# Leaf names are assumed to be distinct within a tree.  The smallest leaf name
+# of each subtree is found in one postorder pass, and the newick is written by
+# a second walk that never recurses, so deep trees are fine.
+import hashlib
+
+
+def canonical_newick(tree):
+    """Returns the canonical newick of a treelib.Tree or arraytreelib.ArrayTree"""
+    children, names, root = _node_arrays(tree)
+
+    # smallest leaf name beneath each node (nodes are in postorder)
+    keys = []
+    for i, kids in enumerate(children):
+        if kids:
+            keys.append(min(keys[j] for j in kids))
+        else:
+            keys.append(str(names[i]))
+
+    tokens = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            tokens.append(item)
+            continue
+        kids = children[item]
+        if not kids:
+            tokens.append(keys[item])
+            continue
+        kids = sorted(kids, key=keys.__getitem__)
+        tokens.append("(")
+        stack.append(")")
+        for j in xrange(len(kids) - 1, 0, -1):
+            stack.append(kids[j])
+            stack.append(",")
+        stack.append(kids[0])
+    tokens.append(";")
+    return "".join(tokens)
+
+
+def canonical_hash(tree):
+    """Returns a hex digest of the canonical newick of a tree"""
+    return hashlib.sha1(canonical_newick(tree)).hexdigest()
+
+
+def group_topologies(trees):
+    """Returns a list of the indices of the trees of each topology, in the
+    order each topology first appears"""
+    groups = {}
+    order = []
+    for i, tree in enumerate(trees):
+        key = canonical_hash(tree)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = []
+            order.append(group)
+        group.append(i)
+    return order
+
+
+def _node_arrays(tree):
+    """Returns (children, names, root) of a tree with nodes numbered in
+    postorder"""
+    # ArrayTrees are already in postorder (checked without importing numpy)
+    if hasattr(tree, "starts"):
+        parents = tree.parents.tolist()
+        children = [[] for i in xrange(len(parents))]
+        for i, parent in enumerate(parents):
+            if parent >= 0:
+                children[parent].append(i)
+        return children, tree.names, len(parents) - 1
+
+    index = {}
+    children = []
+    names = []
+    for node in tree.postorder():
+        index[node] = len(names)
+        children.append([index[child] for child in node.children])
+        names.append(node.name)
+    return children, names, len(names) - 1
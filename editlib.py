@@ -0,0 +1,436 @@
+# Incremental feasibility under tree edits
+#
+# A session keeps, for each branch, the count of leaves beneath it for each
+# label on it (its plct labels: 0 < count < total), and the connected
+# components of the LEG with the species and loci in each.
+#
+# An edit that moves a subtree S only changes the counts of the labels on
+# the branch above S, and only on the branches between its old and new
+# place, so counts are updated along those paths.  Labels that reach a
+# branch join the components of the labels there (merging the smaller
+# component into the larger).  A component that loses a label from a branch
+# may split: a search of the LEG from that label stops as soon as it reaches
+# the labels that stayed on the branch, and only parts that did split off
+# are relabeled.
+#
+# An edit therefore costs time proportional to the paths it changes and the
+# parts of the LEG it searches, not to the tree.
+import collections
+
+from rasmus import treelib
+
+import plctlib
+
+
+class EditSession(object):
+    """An editable tree that keeps track of its feasibility
+
+    tree    -- a treelib.Tree, edited in place
+    mapping -- leaf name format (see plctlib.group_leaves)
+    """
+
+    def __init__(self, tree, mapping='sli_'):
+        self.tree = tree
+        self.mapping = mapping
+
+        groupings = plctlib.group_leaves(tree, mapping)
+        self.totals = dict((label, len(leaves))
+                           for label, leaves in groupings.iteritems())
+
+        # label counts of each branch (by the node beneath it)
+        self.counts = dict((node, {}) for node in tree)
+        for label, leaves in groupings.iteritems():
+            lca = treelib.lca(leaves)
+            for leaf in leaves:
+                node = leaf
+                while node is not lca:
+                    counts = self.counts[node]
+                    counts[label] = counts.get(label, 0) + 1
+                    node = node.parent
+
+        # branches carrying each label
+        self.branches = dict((label, set()) for label in self.totals)
+        for node, counts in self.counts.iteritems():
+            for label in counts:
+                self.branches[label].add(node)
+
+        # components: id of each label, labels and loci of each component
+        self.component = {}
+        self.members = {}
+        self.loci = {}
+        self.conflicting = {}  # number of species with two loci
+        self._nextid = 0
+        self._build_components(self.totals)
+
+        # branches that gained labels, and the labels each lost, in an edit
+        self._added = set()
+        self._removed = {}
+
+    def is_feasible(self):
+        """Returns True if no component has two loci of a species"""
+        return not self.conflicting
+
+    def get_conflicts(self):
+        """Returns the conflicting components (as in plctlib.get_conflicts)"""
+        return set(tuple(self.members[cid]) for cid in self.conflicting)
+
+    def labels(self, node):
+        """Returns the labels on the branch above node"""
+        return set(self.counts[node])
+
+    def connected_components(self):
+        """Iterate through the components of the LEG"""
+        return self.members.itervalues()
+
+    #=========================================================================
+    # edits
+
+    def spr(self, node, target):
+        """Prune the subtree at node and regraft it above target
+
+        A new node joins node and target.  The old parent of node is removed
+        if it is left with one child.  Returns the new node.
+        """
+        parent = node.parent
+        if parent is None:
+            raise Exception("cannot prune the root")
+        if _is_descendant(target, node):
+            raise Exception("cannot regraft a subtree within itself")
+
+        # counts of the subtree: branches between its old and new place lose
+        # or gain them
+        moved = self.counts[node]
+        stop = _lca(parent, target.parent)
+        self._shift(parent, stop, moved, {})
+        self._shift(target.parent, stop, {}, moved)
+
+        self.tree.remove(node)
+        self.tree.add(node)
+        joint = self._insert_above(target)
+        self.tree.add_child(joint, node)
+        self._set_counts(joint, _add_counts(self.counts[target], moved))
+
+        if len(parent.children) == 1:
+            self._suppress(parent)
+        self._update_components()
+        return joint
+
+    def swap(self, node1, node2):
+        """Exchange two disjoint subtrees"""
+        if _is_descendant(node1, node2) or _is_descendant(node2, node1):
+            raise Exception("cannot swap nested subtrees")
+        parent1, parent2 = node1.parent, node2.parent
+        if parent1 is parent2:
+            return
+
+        counts1, counts2 = self.counts[node1], self.counts[node2]
+        stop = _lca(parent1, parent2)
+        self._shift(parent1, stop, counts1, counts2)
+        self._shift(parent2, stop, counts2, counts1)
+
+        i = parent1.children.index(node1)
+        j = parent2.children.index(node2)
+        parent1.children[i], parent2.children[j] = node2, node1
+        node1.parent, node2.parent = parent2, parent1
+        self._update_components()
+
+    def nni(self, node, sibling):
+        """Nearest neighbor interchange: swap node with a sibling of its parent"""
+        if (node.parent is None or node.parent.parent is None or
+                sibling.parent is not node.parent.parent or
+                sibling is node.parent):
+            raise Exception("not a nearest neighbor interchange")
+        self.swap(node, sibling)
+
+    def contract(self, node):
+        """Remove the branch above an internal node, its children join its
+        parent"""
+        if node.parent is None or node.is_leaf():
+            raise Exception("can only contract internal branches")
+        self._removed[node] = set(self.counts[node])
+        self._delete(node)
+        self._update_components()
+
+    def expand(self, node, children):
+        """Add a branch joining some of the children of node
+
+        Returns the new node.
+        """
+        children = list(children)
+        if (len(children) < 2 or len(children) >= len(node.children) or
+                any(child.parent is not node for child in children)):
+            raise Exception("can only expand a proper subset of children")
+
+        # a label on the new branch is on the branch above some child
+        counts = {}
+        for child in children:
+            counts = _add_counts(counts, self.counts[child])
+
+        joint = self.tree.new_node()
+        for child in children:
+            node.children.remove(child)
+            self.tree.add_child(joint, child)
+        self.tree.add_child(node, joint)
+        self.counts[joint] = {}
+        self._set_counts(joint, counts)
+        self._update_components()
+        return joint
+
+    #=========================================================================
+    # label counts
+
+    def _shift(self, node, stop, minus, plus):
+        """Update the counts of node and its ancestors up to (not including)
+        stop, as a subtree with counts minus leaves them and one with counts
+        plus joins them
+
+        A label missing from the counts of these nodes has a count of its
+        total if it is in minus (the nodes hold that subtree), else 0.
+        """
+        while node is not stop:
+            counts = self.counts[node]
+            for label, count in minus.iteritems():
+                self._set(node, label,
+                          counts.get(label, self.totals[label]) - count)
+            for label, count in plus.iteritems():
+                self._set(node, label, counts.get(label, 0) + count)
+            node = node.parent
+
+    def _set(self, node, label, count):
+        """Set the count of a label on the branch above node"""
+        counts = self.counts[node]
+        if 0 < count < self.totals[label]:
+            if label not in counts:
+                self.branches[label].add(node)
+                self._added.add(node)
+            counts[label] = count
+        elif label in counts:
+            del counts[label]
+            self.branches[label].discard(node)
+            self._removed.setdefault(node, set()).add(label)
+
+    def _set_counts(self, node, counts):
+        """Set the counts of a new branch"""
+        for label, count in counts.iteritems():
+            self._set(node, label, count)
+
+    def _insert_above(self, node):
+        """Returns a new node between node and its parent"""
+        joint = self.tree.new_node()
+        self.counts[joint] = {}
+        parent = node.parent
+        if parent is None:
+            self.tree.root = joint
+        else:
+            parent.children[parent.children.index(node)] = joint
+            joint.parent = parent
+        node.parent = None
+        self.tree.add_child(joint, node)
+        return joint
+
+    def _suppress(self, node):
+        """Remove a node with one child
+
+        The child has the same labels, so components do not change, and
+        labels the node lost in this edit are checked from the child.
+        """
+        child = node.children[0]
+        if node in self._removed:
+            self._removed.setdefault(child, set()).update(
+                self._removed.pop(node))
+
+        if node.parent is None:
+            self._delete_branch(child)
+            child.parent = None
+            node.children = []
+            self._delete_branch(node)
+            del self.counts[node]
+            self.tree.remove(node)
+            self.tree.root = child
+        else:
+            self._delete(node)
+
+    def _delete(self, node):
+        """Remove an internal node, its children join its parent"""
+        self._delete_branch(node)
+        del self.counts[node]
+        parent = node.parent
+        i = parent.children.index(node)
+        parent.children[i:i+1] = node.children
+        for child in node.children:
+            child.parent = parent
+        node.children = []
+        node.parent = None
+        self.tree.remove(node)
+
+    def _delete_branch(self, node):
+        """Remove the labels of the branch above node"""
+        for label in self.counts[node]:
+            self.branches[label].discard(node)
+        self.counts[node] = {}
+
+    #=========================================================================
+    # components
+
+    def _update_components(self):
+        """Merge the components joined by the last edit and split the ones
+        it disconnected"""
+        for node in self._added:
+            if node not in self.counts:
+                continue
+            labels = list(self.counts[node])
+            for label in labels[1:]:
+                self._union(labels[0], label)
+
+        # a component can only split between the labels that left a branch
+        # and one label that stayed there
+        targets = collections.defaultdict(set)
+        for node, labels in self._removed.iteritems():
+            labels = set(labels)
+            for label in self.counts.get(node, ()):
+                labels.add(label)
+                break
+            for label in labels:
+                targets[self.component[label]].add(label)
+        for cid, labels in targets.iteritems():
+            self._split(cid, labels)
+
+        self._added = set()
+        self._removed = {}
+
+    def _split(self, cid, targets):
+        """Split a component into the parts that hold the targets"""
+        targets = set(targets)
+        while targets:
+            found, complete = self._search(targets.pop(), targets)
+            if complete:
+                break
+            # found is a part without the other targets
+            part = self._new_component()
+            for label in found:
+                self._remove_member(cid, label)
+                self._add_member(part, label)
+            targets -= found
+
+        if not self.members[cid]:
+            del self.members[cid]
+            del self.loci[cid]
+
+    def _search(self, start, targets=None):
+        """Returns (labels, complete) for a search of the LEG from start
+
+        The search stops once it has found all targets, then complete is
+        True.  Otherwise labels is the whole component of start.
+        """
+        remaining = set(targets) if targets is not None else None
+        found = set([start])
+        if remaining is not None and not remaining:
+            return found, True
+        seen = set()
+        stack = [start]
+        while stack:
+            label = stack.pop()
+            for node in self.branches[label]:
+                if node in seen:
+                    continue
+                seen.add(node)
+                for other in self.counts[node]:
+                    if other not in found:
+                        found.add(other)
+                        stack.append(other)
+                        if remaining is not None:
+                            remaining.discard(other)
+                            if not remaining:
+                                return found, True
+        return found, remaining is not None and not remaining
+
+    def _union(self, label1, label2):
+        """Merge the components of two labels"""
+        cid1, cid2 = self.component[label1], self.component[label2]
+        if cid1 == cid2:
+            return
+        if len(self.members[cid1]) < len(self.members[cid2]):
+            cid1, cid2 = cid2, cid1
+
+        members = self.members.pop(cid2)
+        self.loci.pop(cid2)
+        self.conflicting.pop(cid2, None)
+        for label in members:
+            self._add_member(cid1, label)
+
+    def _new_component(self):
+        """Returns the id of a new empty component"""
+        cid = self._nextid
+        self._nextid += 1
+        self.members[cid] = set()
+        self.loci[cid] = collections.defaultdict(set)
+        return cid
+
+    def _add_member(self, cid, label):
+        """Add a label to a component"""
+        species, locus = label
+        self.component[label] = cid
+        self.members[cid].add(label)
+        loci = self.loci[cid][species]
+        loci.add(locus)
+        if len(loci) == 2:
+            self.conflicting[cid] = self.conflicting.get(cid, 0) + 1
+
+    def _remove_member(self, cid, label):
+        """Remove a label from a component"""
+        species, locus = label
+        self.members[cid].remove(label)
+        loci = self.loci[cid][species]
+        loci.remove(locus)
+        if len(loci) == 1:
+            self.conflicting[cid] -= 1
+            if not self.conflicting[cid]:
+                del self.conflicting[cid]
+
+    def _build_components(self, labels):
+        """Find the components of labels from their branches"""
+        for start in labels:
+            if start not in self.component:
+                cid = self._new_component()
+                for label in self._search(start)[0]:
+                    self._add_member(cid, label)
+
+
+def _add_counts(counts1, counts2):
+    """Returns the summed counts of two disjoint subtrees"""
+    counts = dict(counts1)
+    for label, count in counts2.iteritems():
+        counts[label] = counts.get(label, 0) + count
+    return counts
+
+
+def _is_descendant(node, ancestor):
+    """Returns True if node is ancestor or lies beneath it"""
+    while node is not None:
+        if node is ancestor:
+            return True
+        node = node.parent
+    return False
+
+
+def _lca(node1, node2):
+    """Returns the lowest common ancestor of two nodes (None if either is
+    None)
+
+    Walks up from both nodes in turn, so it only visits the paths to the lca.
+    """
+    if node1 is None or node2 is None:
+        return None
+    seen = set()
+    while node1 is not None or node2 is not None:
+        if node1 is not None:
+            if node1 in seen:
+                return node1
+            seen.add(node1)
+            node1 = node1.parent
+        if node2 is not None:
+            if node2 in seen:
+                return node2
+            seen.add(node2)
+            node2 = node2.parent
+    return None
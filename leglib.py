@@ -0,0 +1,423 @@
+# Locus Enumeration Graphs (LEG)
+#
+# The LEG of a plct has one node per label (species, locus) and an edge
+# between every pair of labels that share a branch.  Feasibility only depends
+# on the connected components of the LEG, so besides networkx graphs this
+# module provides LEG structures that compute the components directly.
+#
+# Code that only needs components should use connected_components and
+# node_connected_component, which accept any LEG structure.
+#
+# Graph LEGs are LEGGraphs unless the networkx backend is selected with
+# set_graph_backend.  networkx (networkx graphs and exports) and numpy/scipy
+# (sparse LEGs) are imported only when those structures are used.
+import sys
+
+
+# class of graph LEGs: "native" (LEGGraph) or "networkx" (networkx.Graph)
+GRAPH_BACKEND = "native"
+
+
+def set_graph_backend(backend):
+    """Select the class of new graph LEGs ("native" or "networkx")"""
+    global GRAPH_BACKEND
+    if backend not in ("native", "networkx"):
+        raise Exception("graph backend not supported: %s" % backend)
+    GRAPH_BACKEND = backend
+
+
+def new_graph(labels=()):
+    """Returns an empty graph LEG with the given labels as nodes"""
+    if GRAPH_BACKEND == "networkx":
+        import networkx as nx
+        graph = nx.Graph()
+    else:
+        graph = LEGGraph()
+    graph.add_nodes_from(labels)
+    return graph
+
+
+def is_graph(leg):
+    """Returns True if leg is a networkx graph"""
+    # a networkx graph can only exist once networkx has been imported
+    nx = sys.modules.get("networkx")
+    return nx is not None and isinstance(leg, nx.Graph)
+
+
+def connected_components(leg):
+    """Iterates over the connected components (sets of labels) of leg"""
+    if is_graph(leg):
+        import networkx as nx
+        return nx.connected_components(leg)
+    return leg.connected_components()
+
+
+def node_connected_component(leg, label):
+    """Returns the set of labels in the connected component of label"""
+    if is_graph(leg):
+        import networkx as nx
+        return nx.node_connected_component(leg, label)
+    return leg.node_connected_component(label)
+
+
+def component_map(leg):
+    """Returns a dict of the component id (0..n-1) of each label of leg"""
+    if isinstance(leg, SparseLEG):
+        return dict(zip(leg.labels, leg.component_ids().tolist()))
+    cmap = {}
+    for i, cc in enumerate(connected_components(leg)):
+        for label in cc:
+            cmap[label] = i
+    return cmap
+
+
+def to_graph(leg):
+    """Returns leg as a networkx graph with an edge per label pair"""
+    if is_graph(leg):
+        return leg
+    return leg.to_graph()
+
+
+def add_branch_edges(graph, labels):
+    """Add an edge to graph for every pair of labels on a branch"""
+    labels = list(labels)
+    nlabels = len(labels)
+    for i in xrange(nlabels):
+        for j in xrange(i+1, nlabels):
+            graph.add_edge(labels[i], labels[j])
+
+
+#=============================================================================
+# native graph LEG
+
+class LEGGraph(object):
+    """An undirected graph of labels stored as adjacency sets
+
+    Implements the parts of the networkx.Graph interface used for LEGs.
+    Components are tracked with a UnionFind as edges are added, so
+    component queries do not traverse the graph.
+    """
+
+    def __init__(self):
+        self.adj = {}
+        self.components = UnionFind()
+
+    def __iter__(self):
+        """Iterate through labels"""
+        return iter(self.adj)
+
+    def __len__(self):
+        """Returns number of labels"""
+        return len(self.adj)
+
+    def __contains__(self, label):
+        return label in self.adj
+
+    def add_node(self, label):
+        if label not in self.adj:
+            self.adj[label] = set()
+            self.components.add(label)
+
+    def add_nodes_from(self, labels):
+        for label in labels:
+            self.add_node(label)
+
+    def add_edge(self, label1, label2):
+        adj = self.adj
+        if label1 in adj:
+            # label pairs recur on many branches
+            if label2 in adj[label1]:
+                return
+        else:
+            self.add_node(label1)
+        if label2 not in adj:
+            self.add_node(label2)
+        adj[label1].add(label2)
+        adj[label2].add(label1)
+        self.components.union(label1, label2)
+
+    def has_edge(self, label1, label2):
+        return label1 in self.adj and label2 in self.adj[label1]
+
+    def neighbors(self, label):
+        """Returns the labels adjacent to label"""
+        return list(self.adj[label])
+
+    def nodes(self):
+        """Returns the labels of the LEG"""
+        return list(self.adj)
+
+    def edges(self):
+        """Returns a list of edges (label pairs), each listed once"""
+        seen = set()
+        edges = []
+        for label, neighbors in self.adj.iteritems():
+            seen.add(label)
+            edges.extend((label, label2) for label2 in neighbors
+                         if label2 not in seen)
+        return edges
+
+    def number_of_edges(self):
+        return sum(len(neighbors) for neighbors in self.adj.itervalues()) // 2
+
+    def connected_components(self):
+        """Iterates over the connected components (sets of labels)"""
+        return iter(self.components.groups())
+
+    def node_connected_component(self, label):
+        """Returns the set of labels in the connected component of label"""
+        root = self.components.find(label)
+        return set(item for item in self.adj
+                   if self.components.find(item) == root)
+
+    def to_graph(self):
+        """Returns the LEG as a networkx graph"""
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from(self.adj)
+        graph.add_edges_from(self.edges())
+        return graph
+
+
+#=============================================================================
+# union-find LEG
+
+class UnionFind(object):
+    """Disjoint sets of hashable items (union by size with path halving)"""
+
+    def __init__(self, items=()):
+        self.parents = {}
+        self.sizes = {}
+        for item in items:
+            self.add(item)
+
+    def __iter__(self):
+        """Iterate through items"""
+        return iter(self.parents)
+
+    def __len__(self):
+        """Returns number of items"""
+        return len(self.parents)
+
+    def __contains__(self, item):
+        return item in self.parents
+
+    def add(self, item):
+        """Add item as a singleton set if it is not present"""
+        if item not in self.parents:
+            self.parents[item] = item
+            self.sizes[item] = 1
+
+    def find(self, item):
+        """Returns the representative of the set containing item"""
+        parents = self.parents
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    def union(self, item1, item2):
+        """Merge the sets containing item1 and item2, returns the new root"""
+        root1 = self.find(item1)
+        root2 = self.find(item2)
+        if root1 == root2:
+            return root1
+        if self.sizes[root1] < self.sizes[root2]:
+            root1, root2 = root2, root1
+        self.parents[root2] = root1
+        self.sizes[root1] += self.sizes.pop(root2)
+        return root1
+
+    def groups(self):
+        """Returns a list of the sets"""
+        groups = {}
+        for item in self.parents:
+            groups.setdefault(self.find(item), set()).add(item)
+        return groups.values()
+
+
+class UnionFindLEG(object):
+    """A LEG that tracks components without materializing label cliques
+
+    The components of the LEG are the label side components of the
+    bipartite graph between branches and their labels.  Each label on a
+    branch is merged with the first label of the branch, so construction
+    costs O(total label occurrences) instead of O(labels^2) per branch.
+    The branch label lists are kept so that explicit edges can be built on
+    request with to_graph.
+    """
+
+    def __init__(self, labels=()):
+        self.components = UnionFind(labels)
+        self.branches = []
+
+    @classmethod
+    def from_plct(cls, plct, labels):
+        """Creates a union-find LEG from the branch labels of plct"""
+        leg = cls(labels)
+        for node in plct:
+            if node.data["labels"]:
+                leg.add_branch(node.data["labels"])
+        return leg
+
+    def __iter__(self):
+        """Iterate through labels"""
+        return iter(self.components)
+
+    def __len__(self):
+        """Returns number of labels"""
+        return len(self.components)
+
+    def __contains__(self, label):
+        return label in self.components
+
+    def nodes(self):
+        """Returns the labels of the LEG"""
+        return list(self.components)
+
+    def add_branch(self, labels):
+        """Merge the components of all labels on a branch"""
+        labels = list(labels)
+        self.branches.append(labels)
+        if not labels:
+            return
+        first = labels[0]
+        for label in labels[1:]:
+            self.components.union(first, label)
+
+    def connected_components(self):
+        """Iterates over the connected components (sets of labels)"""
+        return iter(self.components.groups())
+
+    def node_connected_component(self, label):
+        """Returns the set of labels in the connected component of label"""
+        root = self.components.find(label)
+        return set(item for item in self.components
+                   if self.components.find(item) == root)
+
+    def to_graph(self):
+        """Returns the LEG as a networkx graph"""
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from(self.components)
+        for labels in self.branches:
+            add_branch_edges(graph, labels)
+        return graph
+
+
+#=============================================================================
+# sparse LEG
+
+class SparseLEG(object):
+    """A LEG stored as a sparse branch x label incidence matrix
+
+    Components are found with scipy.sparse.csgraph on the bipartite graph
+    between branches and labels; two labels are connected in this graph
+    exactly when they are connected in the LEG.  Components that are already
+    known can be given as a UnionFind over the label indices.
+    """
+
+    def __init__(self, labels, incidence, components=None):
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError:
+            raise Exception("sparse LEG requires numpy and scipy")
+        self.labels = list(labels)
+        self.incidence = sparse.csr_matrix(incidence)
+        self._lookup = dict((label, i) for i, label in enumerate(self.labels))
+        self._ncomponents = None
+        self._component_ids = None
+        if components is not None:
+            self._ncomponents, self._component_ids = _renumber(
+                np.array([components.find(i) for i in xrange(len(labels))],
+                         dtype=np.int64))
+
+    @classmethod
+    def from_plct(cls, plct, labels):
+        """Creates a sparse LEG from the branch labels of plct"""
+        import numpy as np
+        from scipy import sparse
+        labels = list(labels)
+        lookup = dict((label, i) for i, label in enumerate(labels))
+        rows = []
+        cols = []
+        for i, node in enumerate(plct):
+            for label in node.data["labels"]:
+                rows.append(i)
+                cols.append(lookup[label])
+        incidence = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=bool), (rows, cols)),
+            shape=(len(plct), len(labels)))
+        return cls(labels, incidence)
+
+    def __iter__(self):
+        """Iterate through labels"""
+        return iter(self.labels)
+
+    def __len__(self):
+        """Returns number of labels"""
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self._lookup
+
+    def nodes(self):
+        """Returns the labels of the LEG"""
+        return list(self.labels)
+
+    def component_ids(self):
+        """Returns an array with the component id of each label"""
+        if self._component_ids is None:
+            import numpy as np
+            from scipy import sparse
+            from scipy.sparse import csgraph
+            # branches and labels are the nodes of one graph (edges are taken
+            # in one direction only, which is enough when undirected)
+            nbranches, nlabels = self.incidence.shape
+            incidence = self.incidence.tocoo()
+            size = nbranches + nlabels
+            bipartite = sparse.csr_matrix(
+                (np.ones(incidence.nnz, dtype=bool),
+                 (incidence.row, incidence.col + nbranches)),
+                shape=(size, size))
+            ncomponents, ids = csgraph.connected_components(
+                bipartite, directed=False)
+
+            # renumber so that only label components remain
+            ids = ids[nbranches:]
+            self._ncomponents, self._component_ids = _renumber(ids)
+        return self._component_ids
+
+    def connected_components(self):
+        """Iterates over the connected components (sets of labels)"""
+        ids = self.component_ids()
+        components = [set() for i in xrange(self._ncomponents)]
+        for label, i in zip(self.labels, ids):
+            components[i].add(label)
+        return iter(components)
+
+    def node_connected_component(self, label):
+        """Returns the set of labels in the connected component of label"""
+        import numpy as np
+        ids = self.component_ids()
+        cid = ids[self._lookup[label]]
+        return set(self.labels[i] for i in np.flatnonzero(ids == cid))
+
+    def to_graph(self):
+        """Returns the LEG as a networkx graph"""
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from(self.labels)
+        indptr, indices = self.incidence.indptr, self.incidence.indices
+        for i in xrange(self.incidence.shape[0]):
+            add_branch_edges(graph, (self.labels[j] for j in
+                                     indices[indptr[i]:indptr[i+1]]))
+        return graph
+
+
+def _renumber(ids):
+    """Renumber ids to 0..n-1, returns (n, new ids)"""
+    import numpy as np
+    uniq, ids = np.unique(ids, return_inverse=True)
+    return len(uniq), ids
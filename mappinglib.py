@@ -0,0 +1,123 @@
+# Leaf name mappings
+#
+# A mapping turns a leaf name into its (species, locus, ind).  It is given as
+# a spec string, compiled once (see get_mapping) into a NameMapping:
+#
+#   fields and a delimiter -- "s" species, "l" locus, "i" individual and "x"
+#       a field to skip, in the order they appear, then an optional delimiter
+#       (default "-").  The name is split on the delimiter and must have one
+#       part per field.  The original layouts are of this form: "sli" is
+#       species-locus-ind and "sil_" is species_ind_locus, while "slxi|" reads
+#       names like "human|chr1|extra|3".
+#   a regular expression -- with named groups "species" and "locus" (and
+#       optionally "ind"), matched at the start of the name.
+#
+# NameMapping.labels maps a list of names in one pass, so callers can map the
+# leaves of a tree once and keep the labels.
+import operator
+import re
+
+
+# field letters, then an optional delimiter
+_FIELDS = re.compile(r"^([slix]+)([^slix(]?)$")
+
+# compiled mappings by spec (cleared when it grows past this size)
+MAX_CACHED = 64
+_mappings = {}
+
+
+class NameMapping(object):
+    """A compiled leaf name mapping
+
+    spec -- fields and delimiter, or regular expression (see above)
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.regex = None
+        if not isinstance(spec, basestring):
+            raise Exception("mapping not supported: %s" % spec)
+
+        fields = _FIELDS.match(spec)
+        if fields is not None:
+            letters, delim = fields.groups()
+            if (letters.count("s") != 1 or letters.count("l") != 1 or
+                    letters.count("i") > 1):
+                raise Exception("mapping not supported: %s" % spec)
+            self.delim = delim or "-"
+            self.nfields = len(letters)
+            self._label = operator.itemgetter(letters.index("s"),
+                                              letters.index("l"))
+            self._ind = letters.find("i")
+        else:
+            try:
+                self.regex = re.compile(spec)
+            except re.error:
+                raise Exception("mapping not supported: %s" % spec)
+            if not set(["species", "locus"]) <= set(self.regex.groupindex):
+                raise Exception("mapping not supported: %s" % spec)
+
+    def __repr__(self):
+        return "<name mapping %r>" % self.spec
+
+    def parse(self, name):
+        """Returns the (species, locus, ind) of a leaf name (ind is None if
+        the mapping has none)"""
+        if self.regex is not None:
+            match = self._match(name)
+            return match.group("species", "locus") + (
+                match.groupdict().get("ind"),)
+
+        parts = name.split(self.delim)
+        if len(parts) != self.nfields:
+            self._mismatch(name)
+        return self._label(parts) + (
+            parts[self._ind] if self._ind >= 0 else None,)
+
+    def label(self, name):
+        """Returns the (species, locus) label of a leaf name"""
+        if self.regex is not None:
+            return self._match(name).group("species", "locus")
+        parts = name.split(self.delim)
+        if len(parts) != self.nfields:
+            self._mismatch(name)
+        return self._label(parts)
+
+    def labels(self, names):
+        """Returns the (species, locus) label of each leaf name"""
+        if self.regex is not None:
+            match = self.regex.match
+            matches = [match(name) for name in names]
+            if None in matches:
+                self._mismatch(names[matches.index(None)])
+            return [m.group("species", "locus") for m in matches]
+
+        delim, nfields = self.delim, self.nfields
+        splits = [name.split(delim) for name in names]
+        for i, parts in enumerate(splits):
+            if len(parts) != nfields:
+                self._mismatch(names[i])
+        return map(self._label, splits)
+
+    def _match(self, name):
+        match = self.regex.match(name)
+        if match is None:
+            self._mismatch(name)
+        return match
+
+    def _mismatch(self, name):
+        raise Exception("leaf name does not match mapping %s: %s" %
+                        (self.spec, name))
+
+
+def get_mapping(mapping):
+    """Returns the NameMapping of a spec, compiling it once"""
+    if isinstance(mapping, NameMapping):
+        return mapping
+    compiled = _mappings.get(mapping)
+    if compiled is None:
+        compiled = NameMapping(mapping)
+        if len(_mappings) >= MAX_CACHED:
+            _mappings.clear()
+        _mappings[mapping] = compiled
+    return compiled
@@ -6,12 +6,14 @@
 # This class is a wrapper for biopython phylo trees. We chose to implement
 # it this way in order to hide the implementation details and better illustrate
 # that multifurcating trees can be binarized while maintaining (in)feasibility
-from Bio import Phylo
-import networkx as nx
+#
+# Biopython and networkx are imported when a tree is created, so importing
+# this module stays cheap.
 
 
 class Tree:
     def __init__(self, tree_file):
+        from Bio import Phylo
         self.tree = Phylo.read(tree_file, 'newick')
         self.LEG = self.generate_LEG()
 
@@ -25,6 +27,7 @@ class Tree:
         return not self.tree.is_bifurcating()
 
     def draw_tree(self):
+        from Bio import Phylo
         Phylo.draw_ascii(self.tree)
 
     def draw_LEG(self):
@@ -32,6 +35,7 @@ class Tree:
         print self.LEG.nodes()
 
     def is_feasible(self):
+        import networkx as nx
         for cc in nx.connected_components(self.LEG):
             for i in xrange(0, len(cc)):
                 for j in xrange(i+1, len(cc)):
@@ -40,6 +44,7 @@ class Tree:
         return True
 
     def generate_LEG(self):
+        import networkx as nx
         LEG = nx.Graph()
         LEG.add_nodes_from([terminal.name for terminal in self.tree.get_terminals()])
         group_paths = {}
@@ -161,6 +166,7 @@ class Tree:
                 else:
                     # Arbitrarily choose the first loci on the parent edge because all the loci with
                     # paths on parent edge are in the same connected component regardless
+                    import networkx as nx
                     cc = nx.node_connected_component(self.LEG, self.loci(paths_on_parent_edge.pop()))
                     if len(cc) == 1:
                         cc = cc.pop()
@@ -11,25 +11,18 @@
 # A lot of the code for creating the LEG was repurposed for this class from Prof
 # Wu's plctlib. get_conflicts and annotate have not yet been tested
 from rasmus import treelib
-import networkx as nx
 import collections
 
+import leglib
+import mappinglib
+
 def parse_gene(gene, mapping='sli_'):
-    if mapping == 'sli':
-        species, locus, ind = gene.split('-')  # leaf format = "species-locus-ind"
-    elif mapping == 'sil':
-        species, ind, locus = gene.split('-')  # leaf format = "species-ind-locus"
-    elif mapping == 'sli_':
-        species, locus, ind = gene.split('_')  # leaf format = "species_locus_ind"
-    elif mapping == 'sil_':
-        species, ind, locus = gene.split('_')  # leaf format = "species_ind_locus"
-    else:
-        raise Exception("mapping not supported: %s" % mapping)
-
-    return (species, locus, ind)
+    # mapping is a leaf name format such as 'sli_' = "species_locus_ind", or
+    # a regular expression (see mappinglib)
+    return mappinglib.get_mapping(mapping).parse(gene)
 
 class Tree(object):
-    def __init__(self, tree_file, mapping='sli_'):
+    def __init__(self, tree_file, mapping='sli_', leg_mode='graph'):
         # add a handle to the tree because the algorithm breaks when theres a
         # multifurcation at the root
         self.tree = treelib.Tree()
@@ -37,23 +30,59 @@ class Tree(object):
         self.tree.add_tree(self.tree.root, treelib.read_newick(tree_file))
         self.labeled = False
         self.mapping = mapping
+        # label of each leaf name, mapped once when the tree is loaded
+        leaves = self.tree.leaves()
+        self.leaf_labels = dict(zip(
+            [leaf.name for leaf in leaves],
+            mappinglib.get_mapping(mapping).labels(
+                [leaf.name for leaf in leaves])))
+        # 'graph' for a graph LEG (see leglib.new_graph), 'sparse' for a
+        # leglib.SparseLEG, 'components' for a leglib.UnionFindLEG
+        self.leg_mode = leg_mode
         self.leg = self.create_leg()
+        # (leg, label -> component id) for the current leg
+        self._component_map = (None, None)
 
     # Return the multifurcation status of the tree without the handle
     # Also assumes there is not a node with 1 child
     def is_multifurcating(self):
         return not treelib.is_binary(treelib.subtree(self.tree, self.tree.root.children[0]))
 
-    def draw_tree(self):
-        treelib.draw_tree(self.tree)
+    def draw_tree(self, max_leaves=None, max_width=None):
+        treelib.draw_tree(self.tree, max_leaves=max_leaves,
+                          max_width=max_width)
         # print self.tree.nodes
 
-    def draw_leg(self):
-        # nx.draw(self.LEG)
-        print "Connected Components of LEG:\n" + str(list(nx.connected_components(self.leg)))
+    def draw_leg(self, max_components=None):
+        # nx.draw(self.get_leg_graph())
+        ccs = list(leglib.connected_components(self.leg))
+        if max_components is not None and len(ccs) > max_components:
+            # summarize the remaining components
+            rest = ccs[max_components:]
+            print "Connected Components of LEG:\n" + str(ccs[:max_components])
+            print "... %d more components (largest has %d labels)" % (
+                len(rest), max(len(cc) for cc in rest))
+        else:
+            print "Connected Components of LEG:\n" + str(ccs)
+
+    def get_component_map(self):
+        """Returns a dict of the LEG component id of each label
+
+        The map is computed once per LEG and recomputed when the LEG is
+        replaced.
+        """
+        leg, cmap = self._component_map
+        if leg is not self.leg:
+            cmap = leglib.component_map(self.leg)
+            self._component_map = (self.leg, cmap)
+        return cmap
+
+    def get_leg_graph(self):
+        """Returns the LEG as a networkx graph with an edge per label pair"""
+        return leglib.to_graph(self.leg)
 
     def is_feasible(self):
-        for cc in nx.connected_components(self.leg):
+        for cc in leglib.connected_components(self.leg):
             loci_dct = collections.defaultdict(set)
             for label in cc:
                 species, locus = label
@@ -67,10 +96,7 @@ class Tree(object):
         # collect leaves based on species and locus
         groupings = collections.defaultdict(list)
         for leaf in self.tree.leaves():
-            gene = parse_gene(leaf.name, self.mapping)
-
-            label = gene[:2]
-            groupings[label].append(leaf)
+            groupings[self.leaf_labels[leaf.name]].append(leaf)
 
         return groupings
 
@@ -96,10 +122,16 @@ class Tree(object):
 
     def create_leg(self):
         """Creates leg from plct and groupings."""
-        leg = nx.Graph()
         groupings = self.group_leaves()
         plct = self.create_plct(groupings)
-        leg.add_nodes_from(groupings.keys())  # nodes = (species, locus)
+        if self.leg_mode == 'sparse':
+            return leglib.SparseLEG.from_plct(plct, groupings.keys())
+        elif self.leg_mode == 'components':
+            return leglib.UnionFindLEG.from_plct(plct, groupings.keys())
+        elif self.leg_mode != 'graph':
+            raise Exception("leg mode not supported: %s" % self.leg_mode)
+
+        leg = leglib.new_graph(groupings.keys())  # nodes = (species, locus)
         for node in plct:
             labels = list(node.data["labels"])  # convert label set to label list
             for i in xrange(len(labels)):
@@ -111,7 +143,7 @@ class Tree(object):
     def get_conflicts(self):
         """Find irreconcilable connected components of leg."""
         conflicts = set()  # connected components with conflict
-        for cc in nx.connected_components(self.leg):
+        for cc in leglib.connected_components(self.leg):
             # key = species, val = set of loci in species for this cc
             loci_dct = collections.defaultdict(set)
 
@@ -126,13 +158,20 @@ class Tree(object):
                     break
         return conflicts
 
-    def annotate(self):
-        """Annotate tree."""
+    def annotate(self, backend="python"):
+        """Annotate tree.
+
+        backend -- "python" or "sparse" (see plctlib.annotate)
+        """
         # reconcilable => no labels on this branch are pairwise irreconcilable
         # reconcilable_cc => no labels on this branch are part of irreconcilable cc of leg
         if not self.labeled:
             raise Exception("Cannot annotate because tre is unlabeled.")
         conflicts = self.get_conflicts()
+        if backend != "python":
+            import plctlib
+            plctlib.annotate(self.tree, conflicts, backend, self.group_leaves())
+            return
         conflicting_labels = set()
         for cc in conflicts:
             conflicting_labels.update(cc)
@@ -163,10 +202,10 @@ class Tree(object):
     def get_paths_out(self, from_leaves):
         to_leaves = list(set(self.tree.leaves()) - set(from_leaves))
         has_path = set()
+        labels = self.leaf_labels
         for from_leaf in from_leaves:
             for to_leaf in to_leaves:
-                if parse_gene(from_leaf.name, self.mapping)[:2] == \
-                                parse_gene(to_leaf.name, self.mapping)[:2]:
+                if labels[from_leaf.name] == labels[to_leaf.name]:
                     has_path.add(from_leaf)
         return has_path
 
@@ -209,6 +248,7 @@ class Tree(object):
         if node.is_leaf():
             return
         if len(node.children) > 2:
+            components = self.get_component_map()
             partition = collections.defaultdict(list)
             for child in node:
                 paths_on_parent_edge = []
@@ -222,12 +262,7 @@ class Tree(object):
                 else:
                     # Arbitrarily choose the first loci on the parent edge because all the loci with
                     # paths on parent edge are in the same connected component regardless
-                    cc = nx.node_connected_component(self.leg,
-                                        parse_gene(paths_on_parent_edge.pop().name, self.mapping)[:2])
-                    if len(cc) == 1:
-                        cc = cc.pop()
-                    else:
-                        cc = tuple(cc)
+                    cc = components[self.leaf_labels[paths_on_parent_edge.pop().name]]
                     partition[cc].append(treelib.subtree(self.tree, child))
             no_path = []
             if 'no_path' in partition:
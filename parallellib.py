@@ -0,0 +1,184 @@
+# Parallel plct construction
+#
+# A large tree is cut into disjoint subtrees, either of balanced size or with
+# treelib.max_disjoint_subtrees.  The branch labels of each subtree are
+# computed in worker processes from its own label counts and the label totals
+# of the whole tree.  The remaining nodes (the spine above the cuts) are
+# labeled by merging the label counts of their children, smaller into larger
+# as in plctlib.merge_plct.  Subtrees too small to be worth a task (such as
+# the leaves hanging off a caterpillar) are left on the spine.
+import multiprocessing
+
+import numpy as np
+from scipy import sparse
+
+from rasmus import treelib
+import arraytreelib
+import leglib
+import sharedtreelib
+
+
+# number of subtrees per process in a size-balanced cut
+SUBTREES_PER_PROCESS = 4
+
+# subtrees smaller than this fraction of the target size stay on the spine
+MIN_SUBTREE_FRACTION = 0.125
+
+
+def balanced_subroots(atree, nsubtrees, min_fraction=MIN_SUBTREE_FRACTION):
+    """Returns the roots of the maximal subtrees of at most n/nsubtrees nodes
+
+    Subtrees of fewer than min_fraction of that size are not returned (their
+    nodes are left on the spine).
+    """
+    target = max(1, len(atree) // nsubtrees)
+    sizes = atree.sizes()
+    small = sizes <= target
+
+    # a small node is a subroot if its parent is not small
+    top = np.ones(len(atree), dtype=bool)
+    inner = atree.parents >= 0
+    top[inner] = ~small[atree.parents[inner]]
+    return np.flatnonzero(small & top & (sizes >= target * min_fraction))
+
+
+def disjoint_subroots(tree, atree, subroots):
+    """Returns the roots of treelib.max_disjoint_subtrees as atree indices"""
+    lookup = dict((node, i) for i, node in enumerate(atree.nodes))
+    return np.array(sorted(lookup[node] for node in
+                           treelib.max_disjoint_subtrees(tree, subroots)),
+                    dtype=np.int64)
+
+
+def partial_count_matrix(atree, ids, nids, processes=None, subroots=None,
+                         tree=None):
+    """Parallel version of arraytreelib.partial_count_matrix
+
+    Returns (presence, components) where presence is the sparse (nodes x ids)
+    matrix of arraytreelib.partial_count_matrix and components is a
+    leglib.UnionFind of the ids that share a branch.
+
+    processes -- number of worker processes (default: number of cpus)
+    subroots  -- TreeNodes given to treelib.max_disjoint_subtrees to cut
+                 'tree' (default: cut into subtrees of balanced size)
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if subroots is None:
+        roots = balanced_subroots(atree, processes * SUBTREES_PER_PROCESS)
+    else:
+        roots = disjoint_subroots(tree, atree, subroots)
+    totals = np.bincount(ids[ids >= 0], minlength=nids)
+
+    # the subtree of root r occupies the range starts[r]..r
+    tasks = [[] for i in xrange(processes)]
+    load = [0] * processes
+    order = sorted(roots, key=lambda r: r - atree.starts[r], reverse=True)
+    for root in order:
+        i = load.index(min(load))
+        tasks[i].append((atree.starts[root], root + 1))
+        load[i] += root + 1 - atree.starts[root]
+
+    # workers receive a handle to the tree in shared memory
+    rows = []
+    cols = []
+    components = leglib.UnionFind(xrange(nids))
+    counts = {}
+    shared = sharedtreelib.share_tree(atree, names=False,
+                                      ids=ids, totals=totals)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for results in pool.imap_unordered(
+                _count_subtrees, [(shared, task) for task in tasks if task]):
+            for root, rows2, cols2, root_counts, unions in results:
+                rows.append(rows2)
+                cols.append(cols2)
+                counts[root] = root_counts
+                for i, j in unions:
+                    components.union(i, j)
+    finally:
+        pool.close()
+        pool.join()
+        shared.unlink()
+
+    # the spine is labeled from the labels of the subtree roots (a label
+    # there is on the spine if it also has leaves elsewhere) and of the
+    # spine nodes themselves
+    covered = np.zeros(len(atree) + 1, dtype=np.int64)
+    np.add.at(covered, atree.starts[roots], 1)
+    np.add.at(covered, roots + 1, -1)
+    spine = np.flatnonzero((np.cumsum(covered[:-1]) == 0) & (ids >= 0))
+    nodes = [spine]
+    labels = [ids[spine]]
+    for root in roots:
+        root_labels = np.fromiter(counts[root], dtype=np.int64,
+                                  count=len(counts[root]))
+        nodes.append(np.full(len(root_labels), root, dtype=np.int64))
+        labels.append(root_labels)
+    nodes = np.concatenate(nodes)
+    labels = np.concatenate(labels)
+    order = np.lexsort((nodes, labels))
+    spine_presence = arraytreelib.path_matrix(
+        atree, nodes[order], labels[order], nids, format="coo")
+    for i, j in _component_unions(spine_presence):
+        components.union(i, j)
+
+    rows = np.concatenate(rows + [spine_presence.row])
+    cols = np.concatenate(cols + [spine_presence.col])
+    presence = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(len(atree), nids))
+
+    return presence, components
+
+
+def _component_unions(presence):
+    """Returns pairs of ids that join each id with a branch to the first id
+    of its LEG component (found by scipy, see leglib.SparseLEG)"""
+    nids = presence.shape[1]
+    cids = leglib.SparseLEG(xrange(nids), presence).component_ids()
+    reps = np.unique(cids, return_index=True)[1][cids]
+    moved = np.flatnonzero(reps != np.arange(nids))
+    return zip(moved.tolist(), reps[moved].tolist())
+
+
+def _count_subtrees(args):
+    """Worker: returns the branch labels of each subtree in a task"""
+    shared, task = args
+    atree, arrays = sharedtreelib.attach_tree(shared)
+    ids = arrays["ids"]
+    return [_count_subtree(start,
+                           atree.parents[start:stop] - start,
+                           atree.starts[start:stop] - start,
+                           ids[start:stop], arrays["totals"])
+            for start, stop in task]
+
+
+def _count_subtree(offset, parents, starts, ids, totals):
+    """Returns the branch labels, label counts and label unions of a subtree
+
+    The subtree is given by its slice of parents, starts and ids (relative
+    to 'offset', its position in the whole tree).
+    """
+
+    # relabel ids to those present in the subtree
+    labels, local = np.unique(ids[ids >= 0], return_inverse=True)
+    local_ids = np.full(len(ids), -1, dtype=np.int64)
+    local_ids[ids >= 0] = local
+    root_counts = np.bincount(local, minlength=len(labels))
+
+    parents[-1] = -1
+    atree = arraytreelib.ArrayTree(parents, starts, None, None)
+    presence = arraytreelib.partial_count_matrix(
+        atree, local_ids, len(labels), totals=totals[labels])
+
+    # merge labels sharing a branch
+    unions = [(labels[i], labels[j]) for i, j in _component_unions(presence)]
+
+    # the row of the root is filled in with the spine
+    presence = presence.tocoo()
+    below = presence.row < len(ids) - 1
+    return (offset + len(ids) - 1, presence.row[below] + offset,
+            labels[presence.col[below]], dict(zip(labels, root_counts)),
+            unions)
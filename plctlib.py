@@ -1,18 +1,30 @@
 import collections
-import networkx as nx
 
 from rasmus import treelib
 
+import leglib
+import mappinglib
+
+# the vectorized and parallel backends (numpy and scipy) are imported only
+# when they are used
+
 def is_reconcilable(tree, mapping='sli', annotate=False, return_conflicts=False):
-    """Given a tree, returns True if there exists conficting loci and False otherwise."""
-    groupings = group_leaves(tree, mapping)
-    create_plct(tree, groupings)
-    leg = create_leg(tree, groupings)
-    conflicts = get_conflicts(leg)
-    flag_reconcilable = (len(conflicts) == 0)
+    """Given a tree, returns True if there exists conficting loci and False otherwise.
 
+    Without annotate, the conflicts are found by find_conflicts (or just the
+    flag by is_feasible), which do not label the branches of tree.
+    """
     if annotate:
+        groupings = group_leaves(tree, mapping)
+        create_plct(tree, groupings)
+        leg = create_leg(tree, groupings)
+        conflicts = get_conflicts(leg)
         annotate_tree(tree, conflicts)
+    elif not return_conflicts:
+        return is_feasible(tree, mapping)
+    else:
+        conflicts = find_conflicts(tree, mapping)
+    flag_reconcilable = (len(conflicts) == 0)
 
     if return_conflicts:
         return flag_reconcilable, conflicts
@@ -20,6 +32,153 @@ def is_reconcilable(tree, mapping='sli', annotate=False, return_conflicts=False)
         return flag_reconcilable
 
 
+def find_conflicts(tree, mapping='sli'):
+    """Returns the conflicting components of the leg of tree (as in get_conflicts).
+
+    A fused version of group_leaves, create_plct, create_leg and
+    get_conflicts that leaves node.data untouched (see _fused_components).
+    """
+    totals, find = _fused_components(tree, mapping)
+
+    # components with two loci of a species
+    components = collections.defaultdict(set)
+    for label in totals:
+        components[find(label)].add(label)
+    conflicts = set()
+    for cc in components.itervalues():
+        loci = {}
+        for species, locus in cc:
+            if loci.setdefault(species, locus) != locus:
+                conflicts.add(tuple(cc))
+                break
+    return conflicts
+
+
+def is_feasible(tree, mapping='sli'):
+    """Returns True if tree has no conflicts, stopping at the first one.
+
+    Keeps the species -> locus map of each component while the components
+    are merged, and returns False as soon as a merge gives a species two
+    loci.  node.data is left untouched.
+    """
+    return _fused_components(tree, mapping, early_exit=True) is not None
+
+
+def _fused_components(tree, mapping='sli', early_exit=False):
+    """Returns (totals, find) for the components of the leg of tree.
+
+    totals -- number of leaves of each label
+    find   -- function returning the component root of a label
+
+    The first pass counts the leaves of each label.  The second merges the
+    label counts of the children of each node (smaller dicts into the
+    largest), dropping labels whose count reaches their total.  The labels
+    still open above a child share a branch, so they are already in one
+    component; at each node the components of the children that still have
+    open labels are joined.
+
+    If early_exit is True, returns None as soon as a component has two loci
+    of a species.
+    """
+    # pass 1: labels of the leaves in postorder, and their totals
+    leaf_labels = mappinglib.get_mapping(mapping).labels(
+        [node.name for node in tree.postorder() if node.is_leaf()])
+    totals = collections.defaultdict(int)
+    for label in leaf_labels:
+        totals[label] += 1
+
+    union = dict((label, label) for label in totals)
+    if early_exit:
+        # species -> locus of each component root
+        loci = dict((label, {label[0]: label[1]}) for label in totals)
+    else:
+        loci = None
+
+    def find(label):
+        while union[label] != label:
+            union[label] = union[union[label]]
+            label = union[label]
+        return label
+
+    def join(label1, label2):
+        """Joins two components, returns False if this makes a conflict"""
+        root1, root2 = find(label1), find(label2)
+        if root1 == root2:
+            return True
+        if loci is None:
+            union[root2] = root1
+            return True
+        if len(loci[root1]) < len(loci[root2]):
+            root1, root2 = root2, root1
+        union[root2] = root1
+        loci1 = loci[root1]
+        for species, locus in loci.pop(root2).iteritems():
+            if loci1.setdefault(species, locus) != locus:
+                return False
+        return True
+
+    # pass 2: open label counts of each branch, on a stack in postorder
+    stack = []
+    nleaves = 0
+    for node in tree.postorder():
+        if node.is_leaf():
+            label = leaf_labels[nleaves]
+            nleaves += 1
+            stack.append({label: 1} if totals[label] > 1 else {})
+            continue
+
+        nchildren = len(node.children)
+        children = stack[-nchildren:]
+        del stack[-nchildren:]
+
+        # merge into the largest child; labels new to it are not among its
+        # own open labels
+        big = max(children, key=len)
+        big_size = len(big)
+        big_rep = next(iter(big), None)
+        new = set()
+        closed = []
+        for counts in children:
+            if counts is big:
+                continue
+            for label, count in counts.iteritems():
+                if label in big:
+                    count += big[label]
+                else:
+                    new.add(label)
+                big[label] = count
+                if count == totals[label]:
+                    closed.append(label)
+        for label in closed:
+            del big[label]
+
+        # join the components of children with labels open above node
+        if big:
+            reps = []
+            if big_size > sum(1 for label in closed if label not in new):
+                reps.append(big_rep)
+            for counts in children:
+                if counts is not big:
+                    for label in counts:
+                        if label in big:
+                            reps.append(label)
+                            break
+            for label in reps[1:]:
+                if not join(reps[0], label) and early_exit:
+                    return None
+        stack.append(big)
+
+    return totals, find
+
+
+def leaf_label(name, mapping='sli'):
+    """Returns the (species, locus) label of a leaf name.
+
+    mapping -- a leaf name format or NameMapping (see mappinglib)
+    """
+    return mappinglib.get_mapping(mapping).label(name)
+
+
 def group_leaves(tree, mapping='sli'):
     """Returns dictionary with genes from same species and locus grouped together.
 
@@ -28,29 +187,43 @@ def group_leaves(tree, mapping='sli'):
     """
     # collect leaves based on species and locus
     groupings = collections.defaultdict(list)
-    for leaf in tree.leaves():
-        if mapping == 'sli':
-            species, locus, ind = leaf.name.split('-') # leaf format = "species-locus-ind"
-        elif mapping == 'sil':
-            species, ind, locus = leaf.name.split('-') # leaf format = "species-ind-locus"
-        elif mapping == 'sli_':
-            species, locus, ind = leaf.name.split('_') # leaf format = "species_locus_ind"
-        elif mapping == 'sil_':
-            species, ind, locus = leaf.name.split('_') # leaf format = "species_ind_locus"
-        else:
-            raise Exception("mapping not supported: %s" % mapping)
-
-        label = (species, locus)
+    # postorder does not recurse, so deep (caterpillar) trees are fine
+    leaves = [node for node in tree.postorder() if node.is_leaf()]
+    labels = mappinglib.get_mapping(mapping).labels(
+        [leaf.name for leaf in leaves])
+    for label, leaf in zip(labels, leaves):
         groupings[label].append(leaf)
 
     return groupings
 
 
-def create_plct(tree, groupings, new_copy=False):
-    """Creates plct for tree using groupings."""
+def create_plct(tree, groupings, new_copy=False, backend="python",
+                processes=None, subroots=None):
+    """Creates plct for tree using groupings.
+
+    backend -- "python" walks each leaf up to the lca of its label,
+               "merge" merges the label counts of subtrees (see merge_plct),
+               "sparse" computes labels from subtree label counts (see plct_matrix)
+    processes, subroots -- split the tree for the sparse backend (see plct_matrix)
+    """
     if new_copy:
         tree = tree.copy()
 
+    if backend == "sparse":
+        atree, labels, presence = plct_matrix(tree, groupings,
+                                              processes, subroots)
+        # map the label ids of all entries at once, then slice per node
+        indptr = presence.indptr.tolist()
+        entries = map(labels.__getitem__, presence.indices.tolist())
+        for i, node in enumerate(atree.nodes):
+            node.data["labels"] = set(entries[indptr[i]:indptr[i+1]])
+        return tree
+    elif backend == "merge":
+        merge_plct(tree, groupings)
+        return tree
+    elif backend != "python":
+        raise Exception("plct backend not supported: %s" % backend)
+
     for node in tree:
         node.data["labels"] = set()
 
@@ -66,10 +239,115 @@ def create_plct(tree, groupings, new_copy=False):
     return tree
 
 
-def create_leg(plct, groupings):
-    """Creates leg from plct and groupings."""
-    leg = nx.Graph()
-    leg.add_nodes_from(groupings.keys()) # nodes = (species, locus)
+def merge_plct(tree, groupings):
+    """Labels the branches of tree by merging the label counts of subtrees.
+
+    The counts of the children of each node are merged into those of the
+    child with the most labels, and a label is dropped once its count reaches
+    its number of leaves.  Each label count moves O(log n) times, so apart
+    from copying the label sets into node.data the work is O(n log n) for any
+    tree shape, where walking each leaf up to its lca is O(n^2) on a
+    caterpillar.
+    """
+    # leaves are matched by name, so groupings may come from a copy of tree
+    totals = {}
+    leaf_labels = {}
+    for label, leaves in groupings.iteritems():
+        totals[label] = len(leaves)
+        for leaf in leaves:
+            leaf_labels[leaf.name] = label
+
+    counts = {}
+    for node in tree.postorder():
+        if node.is_leaf():
+            label = leaf_labels[node.name]
+            big = {label: 1} if totals[label] > 1 else {}
+        else:
+            children = [counts.pop(child) for child in node.children]
+            big = max(children, key=len)
+            for small in children:
+                if small is big:
+                    continue
+                for label, count in small.iteritems():
+                    count += big.get(label, 0)
+                    if count == totals[label]:
+                        del big[label]
+                    else:
+                        big[label] = count
+        node.data["labels"] = set(big)
+        counts[node] = big
+    return tree
+
+
+def plct_matrix(tree, groupings, processes=None, subroots=None):
+    """Returns (atree, labels, presence) for the plct of tree.
+
+    atree    -- arraytreelib.ArrayTree of tree
+    labels   -- list of labels, indexing the columns of presence
+    presence -- sparse boolean (nodes x labels) matrix, True if the label is
+                on the branch above the node
+
+    A branch carries a label if the subtree beneath it holds some, but not
+    all, of the leaves with that label.
+
+    If processes or subroots are given, the tree is split into disjoint
+    subtrees that are labeled in worker processes (see parallellib).
+    """
+    atree, labels, ids = _label_ids(tree, groupings)
+    if processes is None and subroots is None:
+        import arraytreelib
+        presence = arraytreelib.partial_count_matrix(atree, ids, len(labels))
+    else:
+        import parallellib
+        presence, components = parallellib.partial_count_matrix(
+            atree, ids, len(labels), processes, subroots, tree)
+    return atree, labels, presence
+
+
+def _label_ids(tree, groupings):
+    """Returns (atree, labels, ids) where ids are the label ids of each node"""
+    try:
+        import arraytreelib
+    except ImportError:
+        raise Exception("sparse plct backend requires numpy and scipy")
+
+    labels = list(groupings.keys())
+    label_ids = {}
+    for i, label in enumerate(labels):
+        for leaf in groupings[label]:
+            label_ids[leaf.name] = i
+
+    atree = arraytreelib.from_tree(tree)
+    return atree, labels, arraytreelib.name_ids(atree, label_ids)
+
+
+def create_leg(plct, groupings, mode="graph", processes=None, subroots=None):
+    """Creates leg from plct and groupings.
+
+    mode -- "graph" builds a graph with an edge per label pair (a
+            leglib.LEGGraph, or a networkx graph if selected with
+            leglib.set_graph_backend),
+            "sparse" builds a leglib.SparseLEG that only tracks components
+            "components" builds a leglib.UnionFindLEG, which also only
+            tracks components (use leglib.to_graph for the edges)
+    processes, subroots -- build the sparse LEG by splitting the tree into
+            disjoint subtrees (see plct_matrix), its components are merged
+            from those of each subtree
+    """
+    if mode == "sparse" and (processes is not None or subroots is not None):
+        import parallellib
+        atree, labels, ids = _label_ids(plct, groupings)
+        presence, components = parallellib.partial_count_matrix(
+            atree, ids, len(labels), processes, subroots, plct)
+        return leglib.SparseLEG(labels, presence, components)
+    elif mode == "sparse":
+        return leglib.SparseLEG.from_plct(plct, groupings.keys())
+    elif mode == "components":
+        return leglib.UnionFindLEG.from_plct(plct, groupings.keys())
+    elif mode != "graph":
+        raise Exception("leg mode not supported: %s" % mode)
+
+    leg = leglib.new_graph(groupings.keys()) # nodes = (species, locus)
     for node in plct:
         labels = list(node.data["labels"]) # convert label set to label list
         nlabels = len(labels)
@@ -83,7 +361,7 @@ def create_leg(plct, groupings):
 def get_conflicts(leg):
     """Find irreconcilable connected components of leg."""
     conflicts = set() # connected components with conflict
-    for cc in nx.connected_components(leg):
+    for cc in leglib.connected_components(leg):
         # key = species, val = set of loci in species for this cc
         loci_dct = collections.defaultdict(set)
 
@@ -99,10 +377,37 @@ def get_conflicts(leg):
     return conflicts
 
 
-def annotate(tree, conflicts):
-    """Annotate tree."""
+def annotate(tree, conflicts, backend="python", groupings=None, matrix=None):
+    """Annotate tree.
+
+    backend -- "python" reads the labels of each branch from the plct,
+               "sparse" computes the flags with annotate_matrix from the
+               plct_matrix of tree
+    matrix  -- (atree, labels, presence) of tree from plct_matrix, for the
+               sparse backend; computed from groupings if not given
+    """
     # reconcilable => no labels on this branch are pairwise irreconcilable
     # reconcilable_cc => no labels on this branch are part of irreconcilable cc of leg
+    if backend == "sparse":
+        if matrix is None:
+            if groupings is None:
+                raise Exception("sparse annotate requires groupings")
+            matrix = plct_matrix(tree, groupings)
+        atree, labels, presence = matrix
+        labeled, reconcilable, reconcilable_cc = annotate_matrix(
+            presence, labels, conflicts)
+        leaves = atree.is_leaf().tolist()
+        reconcilable = reconcilable.tolist()
+        reconcilable_cc = reconcilable_cc.tolist()
+        for i in labeled.nonzero()[0].tolist():
+            data = atree.nodes[i].data
+            data["reconcilable_cc"] = reconcilable_cc[i]
+            if not leaves[i]:
+                data["reconcilable"] = reconcilable[i]
+        return
+    elif backend != "python":
+        raise Exception("annotate backend not supported: %s" % backend)
+
     conflicting_labels = set()
     for cc in conflicts:
         conflicting_labels.update(cc)
@@ -129,3 +434,47 @@ def annotate(tree, conflicts):
             if len(loci) >= 2:
                 node.data["reconcilable"] = False
 
+
+# is_reconcilable's annotate argument hides annotate
+annotate_tree = annotate
+
+
+def annotate_matrix(presence, labels, conflicts):
+    """Returns (labeled, reconcilable, reconcilable_cc) boolean node arrays.
+
+    presence  -- sparse boolean (nodes x labels) matrix (see plct_matrix)
+    labels    -- (species, locus) label of each column
+    conflicts -- conflicting components (see get_conflicts)
+
+    labeled is True for branches with labels; the flags of annotate are
+    only set for those.  reconcilable is True if no species has two loci
+    on the branch, reconcilable_cc if no label of the branch is in a
+    conflicting component.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    presence = sparse.csr_matrix(presence, dtype=np.int32)
+    nnodes, nlabels = presence.shape
+
+    # labels per species on each branch; each label is one locus
+    species = np.unique([label[0] for label in labels],
+                        return_inverse=True)[1]
+    by_species = sparse.csr_matrix(
+        (np.ones(nlabels, dtype=np.int32), (np.arange(nlabels), species)),
+        shape=(nlabels, species.max() + 1 if nlabels else 0))
+    counts = (presence * by_species).tocsr()
+    rows = np.repeat(np.arange(nnodes), np.diff(counts.indptr))
+    reconcilable = np.ones(nnodes, dtype=bool)
+    reconcilable[rows[counts.data >= 2]] = False
+
+    # branches with a label of a conflicting component
+    conflicting_labels = set()
+    for cc in conflicts:
+        conflicting_labels.update(cc)
+    conflicting = np.array([label in conflicting_labels for label in labels],
+                           dtype=np.int32)
+    reconcilable_cc = (presence * conflicting) == 0
+
+    labeled = np.diff(presence.indptr) > 0
+    return labeled, reconcilable, reconcilable_cc
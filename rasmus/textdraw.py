@@ -71,3 +71,57 @@ class TextCanvas:
                 out.write(row[xkey])
                 x += 1
         out.write("\n")
+
+
+class RowCanvas(TextCanvas):
+    """Draw ascii art on preallocated rows of characters
+
+    Stores each row in a bytearray instead of a nested dict.  Rows are
+    allocated up front when the size of the drawing is known and grow as
+    needed.  Characters at x >= maxwidth are dropped.
+    """
+
+    def __init__(self, width=0, height=0, default=' ', maxwidth=None):
+        self.default = default
+        self.maxwidth = maxwidth
+        self.top = 0
+        self.rows = [bytearray(default * width) for i in xrange(height)]
+        self.widths = [0] * height
+
+    def set(self, x, y, char):
+        x = int(x)
+        y = int(y)
+        if x < 0 or (self.maxwidth is not None and x >= self.maxwidth):
+            return
+
+        # grow rows as needed
+        if y < self.top:
+            nrows = self.top - y
+            self.rows[:0] = [bytearray() for i in xrange(nrows)]
+            self.widths[:0] = [0] * nrows
+            self.top = y
+        i = y - self.top
+        if i >= len(self.rows):
+            nrows = i + 1 - len(self.rows)
+            self.rows.extend(bytearray() for j in xrange(nrows))
+            self.widths.extend([0] * nrows)
+        row = self.rows[i]
+        if x >= len(row):
+            row.extend(self.default * (max(x + 1, 2 * len(row)) - len(row)))
+
+        row[x] = char
+        if x >= self.widths[i]:
+            self.widths[i] = x + 1
+
+    def lines(self):
+        """Returns the drawn rows as strings"""
+        # skip unused rows at the top and bottom
+        used = [i for i, width in enumerate(self.widths) if width > 0]
+        if not used:
+            return [""]
+        return [str(self.rows[i][:self.widths[i]])
+                for i in xrange(used[0], used[-1] + 1)]
+
+    def display(self, out=sys.stdout):
+        out.write("\n".join(self.lines()))
+        out.write("\n")
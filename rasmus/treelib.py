@@ -8,8 +8,8 @@
 
 
 # python libs
-import StringIO
 import copy
+import heapq
 import sys
 
 # rasmus libs
@@ -18,10 +18,6 @@ try:
     util
 except ImportError:
     import util
-try:
-    from rasmus import textdraw
-except ImportError:
-    pass
 
 
 # ply parsing support
@@ -609,11 +605,8 @@ class Tree (object):
     def get_one_line_newick(self, root_data=False, writeData=None,
                             namefunc=lambda name: name):
         """Get a presentation of the tree in a oneline string newick format"""
-        stream = StringIO.StringIO()
-        self.write(stream, oneline=True,
-                   writeData=writeData, rootData=root_data,
-                   namefunc=namefunc)
-        return stream.getvalue()
+        return "".join(iter_newick(self, oneline=True, write_data=writeData,
+                                   root_data=root_data, namefunc=namefunc))
 
 
 #============================================================================
@@ -811,6 +804,10 @@ def parse_newick(infile, read_data=None, tree=None,
     return tree
 
 
+# number of text pieces joined per write by write_newick
+NEWICK_CHUNK_SIZE = 1 << 14
+
+
 def write_newick(tree, out=sys.stdout, write_data=None, oneline=False,
                  root_data=False, namefunc=lambda name: name):
     """Write the tree in newick notation"""
@@ -823,50 +820,90 @@ def write_newick_node(tree, node, out=sys.stdout,
                       depth=0, write_data=None, oneline=False,
                       root_data=False, namefunc=lambda name: name):
     """Write the node in newick format to the out file stream"""
+    for chunk in iter_newick(tree, node, depth=depth, write_data=write_data,
+                             oneline=oneline, root_data=root_data,
+                             namefunc=namefunc):
+        out.write(chunk)
+
+
+def iter_newick(tree, node=None, depth=0, write_data=None, oneline=False,
+                root_data=False, namefunc=lambda name: name,
+                chunk_size=NEWICK_CHUNK_SIZE):
+    """Iterates through chunks of the newick text of the subtree at 'node'
+
+    The tree is walked iteratively and its text is joined into chunks of
+    roughly 'chunk_size' pieces, so deep trees do not hit the recursion
+    limit and streams receive few large writes.
+    """
+
+    if node is None:
+        node = tree.root
 
     # default data writer
     if write_data is None:
-        writeDist = any(node.dist != 0 for node in tree)
-        write_data = lambda node: tree.write_data(node, writeDist=writeDist, namefunc=namefunc)
+        writeDist = any(node2.dist != 0 for node2 in tree)
+        tree_write_data = tree.write_data
+        write_data = lambda node: tree_write_data(node, writeDist=writeDist,
+                                                  namefunc=namefunc)
 
-    if not oneline:
-        out.write(" " * depth)
-
-    if len(node.children) == 0:
-        # leaf
-        out.write(str(namefunc(node.name)))
+    if oneline:
+        open_text, sep_text = "(", ","
     else:
-        # internal node
-        if oneline:
-            out.write("(")
+        open_text, sep_text = "(\n", ",\n"
+
+    parts = []
+    append = parts.append
+
+    # stack of [node, depth, index of next child (-1 if not yet visited)]
+    stack = [[node, depth, -1]]
+    while stack:
+        entry = stack[-1]
+        node, depth2, i = entry
+        children = node.children
+
+        if i == -1:
+            if not oneline:
+                append(" " * depth2)
+            if children:
+                # internal node
+                append(open_text)
+                entry[2] = 1
+                stack.append([children[0], depth2 + 1, -1])
+                continue
+            # leaf
+            append(str(namefunc(node.name)))
+
+        elif i < len(children):
+            append(sep_text)
+            entry[2] = i + 1
+            stack.append([children[i], depth2 + 1, -1])
+            continue
+
+        elif oneline:
+            append(")")
         else:
-            out.write("(\n")
-        for child in node.children[:-1]:
-            write_newick_node(tree, child, out, depth+1,
-                              write_data=write_data, oneline=oneline,
-                              namefunc=namefunc)
+            append("\n" + (" " * depth2) + ")")
+
+        # node is finished
+        stack.pop()
+
+        # don't print data for root node
+        if depth2 == 0:
+            if root_data:
+                append(write_data(node))
             if oneline:
-                out.write(",")
+                append(";")
             else:
-                out.write(",\n")
-        write_newick_node(tree, node.children[-1], out, depth+1,
-                          write_data=write_data, oneline=oneline,
-                          namefunc=namefunc)
-        if oneline:
-            out.write(")")
-        else:
-            out.write("\n" + (" " * depth) + ")")
-
-    # don't print data for root node
-    if depth == 0:
-        if root_data:
-            out.write(write_data(node))
-        if oneline:
-            out.write(";")
+                append(";\n")
         else:
-            out.write(";\n")
-    else:
-        out.write(write_data(node))
+            append(write_data(node))
+
+        if len(parts) >= chunk_size:
+            yield "".join(parts)
+            parts[:] = []
+
+    if parts:
+        yield "".join(parts)
 
 
 #=============================================================================
@@ -2326,39 +2363,84 @@ def read_tree_color_map(filename):
 
 def draw_tree(tree, labels={}, scale=40, spacing=2, out=sys.stdout,
               canvas=None, x=0, y=0, display=True, labelOffset=-1,
-              minlen=1, maxlen=10000):
+              minlen=1, maxlen=10000, max_leaves=None, max_width=None):
     """
     Print a ASCII Art representation of the tree
+
+    max_leaves -- collapse clades so that at most this many leaves are drawn.
+                  A collapsed clade is drawn as a leaf giving its size.
+    max_width  -- truncate lines to this many characters (when no canvas is
+                  given)
     """
-    if canvas is None:
-        canvas = textdraw.TextCanvas()
+    from rasmus import textdraw
 
     xscale = scale
     yscale = spacing
 
+    # collapsed clades are drawn as leaves
+    if max_leaves is not None:
+        collapsed = collapse_clades(tree, max_leaves)
+    else:
+        collapsed = {}
+
+    def is_leaf(node):
+        return node.is_leaf() or node in collapsed
+
     # determine node sizes
     sizes = {}
     nodept = {}
-
-    def walk(node):
-        if node.is_leaf():
+    for node in tree.postorder(is_leaf=is_leaf):
+        if is_leaf(node):
             sizes[node] = 1
             nodept[node] = yscale - 1
         else:
-            sizes[node] = 0
-        for child in node.children:
-            sizes[node] += walk(child)
-        if not node.is_leaf():
+            sizes[node] = sum(sizes[child] for child in node.children)
             top = nodept[node.children[0]]
             bot = ((sizes[node] - sizes[node.children[-1]]) * yscale +
                    nodept[node.children[-1]])
             nodept[node] = (top + bot) / 2
-        return sizes[node]
-    walk(tree.root)
 
-    def walk2(node, x, y):
-        # calc coords
+    # layout nodes as (node, x, y, xchildren, post) in the order they are
+    # drawn: branch and children of a node first, its corners (post) last
+    layout = []
+    width = 0
+    stack = [(tree.root, x+0, 0, None)]
+    while stack:
+        node, x, y, xchildren = stack.pop()
+        if xchildren is not None:
+            layout.append((node, x, y, xchildren, True))
+            continue
         xchildren = int(x + min(max(node.dist * xscale, minlen), maxlen))
+        layout.append((node, x, y, xchildren, False))
+        stack.append((node, x, y, xchildren))
+
+        if is_leaf(node):
+            width = max(width, xchildren + 2 + len(
+                _leaf_label(node, collapsed)))
+        else:
+            ychild = y
+            children = []
+            for child in node.children:
+                children.append((child, xchildren, ychild, None))
+                ychild += sizes[child] * yscale
+            stack.extend(reversed(children))
+
+    if canvas is None:
+        canvas = textdraw.RowCanvas(width, sizes[tree.root] * yscale,
+                                    maxwidth=max_width)
+
+    # draw nodes
+    for node, x, y, xchildren, post in layout:
+        if post:
+            if not is_leaf(node):
+                top = y + nodept[node.children[0]]
+                bot = (y + (sizes[node]-sizes[node.children[-1]]) * yscale +
+                       nodept[node.children[-1]])
+                canvas.set(xchildren, y+nodept[node], '+')
+                canvas.set(xchildren, top, '/')
+                canvas.set(xchildren, bot, '\\')
+            canvas.set(x, y+nodept[node], '+')
+            continue
 
         # draw branch
         canvas.line(x, y+nodept[node], xchildren, y+nodept[node], '-')
@@ -2373,8 +2455,9 @@ def draw_tree(tree, labels={}, scale=40, spacing=2, out=sys.stdout,
                         y+nodept[node]+labelOffset,
                         labels[node.name], width=labellen)
 
-        if node.is_leaf():
-            canvas.text(xchildren + 1, y + yscale - 1, str(node.name))
+        if is_leaf(node):
+            canvas.text(xchildren + 1, y + yscale - 1,
+                        _leaf_label(node, collapsed))
         else:
             top = y + nodept[node.children[0]]
             bot = (y + (sizes[node]-sizes[node.children[-1]]) * yscale +
@@ -2383,21 +2466,50 @@ def draw_tree(tree, labels={}, scale=40, spacing=2, out=sys.stdout,
             # draw children
             canvas.line(xchildren, top, xchildren, bot, '|')
 
-            ychild = y
-            for child in node.children:
-                walk2(child, xchildren, ychild)
-                ychild += sizes[child] * yscale
-
-            canvas.set(xchildren, y+nodept[node], '+')
-            canvas.set(xchildren, top, '/')
-            canvas.set(xchildren, bot, '\\')
-        canvas.set(x, y+nodept[node], '+')
-    walk2(tree.root, x+0, 0)
-
     if display:
         canvas.display(out)
 
 
+def collapse_clades(tree, max_leaves):
+    """Choose clades to collapse so that at most max_leaves leaves remain
+
+    The largest clades are expanded first.  Returns a dict of the number of
+    leaves of each collapsed node.
+    """
+    nleaves = {}
+    for node in tree.postorder():
+        if node.is_leaf():
+            nleaves[node] = 1
+        else:
+            nleaves[node] = sum(nleaves[child] for child in node.children)
+
+    # heap of (-leaves, order, node) for the clades drawn
+    heap = [(-nleaves[tree.root], 0, tree.root)]
+    order = 1
+    shown = 1
+    while heap and not heap[0][2].is_leaf():
+        node = heap[0][2]
+        if shown - 1 + len(node.children) > max_leaves:
+            break
+        heapq.heappop(heap)
+        shown += len(node.children) - 1
+        for child in node.children:
+            heapq.heappush(heap, (-nleaves[child], order, child))
+            order += 1
+
+    return dict((node, nleaves[node]) for size, i, node in heap
+                if not node.is_leaf())
+
+
+def _leaf_label(node, collapsed):
+    """Returns the label drawn for a leaf or a collapsed clade"""
+    if node in collapsed:
+        if isinstance(node.name, basestring):
+            return "%s [%d leaves]" % (node.name, collapsed[node])
+        return "[%d leaves]" % collapsed[node]
+    return str(node.name)
+
+
 def draw_tree_lens(tree, *args, **kargs):
     labels = {}
     for node in tree.nodes.values():
@@ -1122,6 +1122,76 @@ class IgnoreCloseFile (object):
         pass
 
 
+# compression formats detected by open_stream
+COMPRESSION_MAGIC = [("gzip", "\x1f\x8b"),
+                     ("bz2", "BZh"),
+                     ("zstd", "\x28\xb5\x2f\xfd")]
+COMPRESSION_EXTS = {".gz": "gzip", ".bz2": "bz2", ".zst": "zstd"}
+
+# buffer size for compressed streams
+COMPRESSION_BUFFER_SIZE = 1 << 20
+
+
+def guess_compression(filename, mode="r"):
+    """Returns the compression of a file ('gzip', 'bz2', 'zstd' or None)
+
+       Existing files opened for reading are detected by their magic bytes,
+       otherwise by the extension of 'filename'.
+    """
+    if "r" in mode and os.path.isfile(filename):
+        with open(filename, "rb") as infile:
+            magic = infile.read(4)
+        for compression, prefix in COMPRESSION_MAGIC:
+            if magic.startswith(prefix):
+                return compression
+        return None
+
+    return COMPRESSION_EXTS.get(os.path.splitext(filename)[1])
+
+
+def open_compressed(filename, compression, mode="r",
+                    buffer_size=COMPRESSION_BUFFER_SIZE):
+    """Opens a compressed file as a buffered stream
+
+       compression: 'gzip', 'bz2' or 'zstd' (requires the zstandard module)
+       mode: r, w or a
+    """
+    import io
+
+    if "r" in mode:
+        mode = "rb"
+    elif "a" in mode:
+        mode = "ab"
+    else:
+        mode = "wb"
+
+    if compression == "gzip":
+        import gzip
+        stream = gzip.GzipFile(filename, mode)
+    elif compression == "bz2":
+        import bz2
+        return bz2.BZ2File(filename, mode, buffering=buffer_size)
+    elif compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd streams require the zstandard module")
+        if mode == "rb":
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                open(filename, mode), read_size=buffer_size)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(
+                open(filename, mode), write_size=buffer_size,
+                write_return_read=True)
+    else:
+        raise Exception("unknown compression '%s'" % compression)
+
+    if mode == "rb":
+        return io.BufferedReader(stream, buffer_size)
+    else:
+        return io.BufferedWriter(stream, buffer_size)
+
+
 def open_stream(filename, mode="r", ignore_close=True):
     """Returns a file stream depending on the type of 'filename' and 'mode'
 
@@ -1130,6 +1200,8 @@ def open_stream(filename, mode="r", ignore_close=True):
            iterator       - returns 'filename' unchanged
            URL string     - opens http pipe
            '-'            - opens stdin or stdout, depending on 'mode'
+           compressed     - opens a gzip, bz2 or zstd file, detected by its
+                            magic bytes when reading or extension otherwise
            other string   - opens file with name 'filename'
        mode: standard mode for file(): r,w,a,b
        ignore_close: if True and filename is a stream, then close() calls on
@@ -1166,9 +1238,13 @@ def open_stream(filename, mode="r", ignore_close=True):
             else:
                 raise Exception("stream '-' can only be opened with modes r/w")
 
-        # open regular file
+        # open regular or compressed file
         else:
-            stream = open(filename, mode)
+            compression = guess_compression(filename, mode)
+            if compression:
+                stream = open_compressed(filename, compression, mode)
+            else:
+                stream = open(filename, mode)
 
     # cannot handle other types for filename
     else:
@@ -0,0 +1,519 @@
+# Component-preserving resolutions of polytomies
+#
+# The children of a multifurcating node are grouped into blocks by the LEG
+# component of the labels on their branch, as in multreelib.binarize_rec.
+# Children without labels are free.  The block of the component of the
+# node's own branch labels is the parent block.
+#
+# A binary resolution adds a branch above each new clade.  The labels of a
+# block close in a clade that holds the whole block, except for the parent
+# block, whose labels continue above the node.  A block is open in a clade
+# that holds some but not all of it (the parent block: any of it).  A
+# resolution is safe if at most one block is open in each new clade.  The
+# safe resolutions are exactly the ones that keep the LEG components of the
+# tree: a clade holding part of a block has a label of its component on its
+# branch, so two open blocks put labels of two components on one branch.
+#
+# Keeping the components keeps the feasibility and the conflicts of the tree,
+# but these are not all the resolutions that keep it feasible.  A resolution
+# that joins components without giving a species two loci also stays
+# feasible, and on an infeasible tree every resolution stays infeasible.
+# Whether a join gives a species two loci depends on the joins made at the
+# other polytomies, so those resolutions do not factor over polytomies and
+# are not counted here.
+#
+# Safe resolutions are counted by dynamic programming over the blocks:
+#
+#   - a free child can be inserted on any edge of a safe resolution, so n
+#     children with f free ones have (2n-2f-1)(2n-2f+1)...(2n-3) times as
+#     many resolutions as the n-f others;
+#   - a clade in which no block is open ("closed") is either the join of two
+#     closed clades, or the smallest clade holding some block B.  That clade
+#     is a skeleton: a binary tree over the children of B and r closed
+#     clades in which every new clade, and both sides of the root, hold a
+#     child of B.  There are G(b, r) = (2b-3)!! (2b-2)(2b-1)...(2b+r-3)
+#     skeletons;
+#   - the node itself is a skeleton over the parent block, where clades may
+#     also join the root ((2p-3)!! (2p-1)(2p)...(2p+r-2) ways), or a closed
+#     clade if there is no parent block.
+#
+# Counts only depend on how many blocks of each size a clade holds, so the
+# tables are indexed by these compositions.  Sampling follows the same
+# decomposition, choosing each step with probability proportional to its
+# count, so resolutions are uniform.
+#
+# Resolutions are nested pairs of the children of the node.
+import collections
+import itertools
+import random
+
+import leglib
+import plctlib
+
+
+def double_factorial(n):
+    """Returns n!! (1 for n <= 0)"""
+    value = 1
+    while n > 1:
+        value *= n
+        n -= 2
+    return value
+
+
+def count_skeletons(nchildren, nclades, top=False):
+    """Returns G(b, r), the number of skeletons over b children and r clades
+
+    top -- if True, clades may also be joined to the root (the skeleton of
+           the parent block)
+    """
+    count = double_factorial(2 * nchildren - 3)
+    for j in xrange(nclades):
+        count *= 2 * nchildren - (1 if top else 2) + j
+    return count
+
+
+def choose(n, k):
+    """Returns the binomial coefficient n choose k"""
+    if k < 0 or k > n:
+        return 0
+    value = 1
+    for i in xrange(min(k, n - k)):
+        value = value * (n - i) // (i + 1)
+    return value
+
+
+class Polytomy(object):
+    """The component-preserving resolutions of a multifurcating node
+
+    node       -- a node with more than two children; its tree must be
+                  labeled with plctlib.create_plct
+    components -- dict of the LEG component id of each label
+                  (see leglib.component_map)
+
+    Iterating yields the resolutions lazily.
+    """
+
+    def __init__(self, node, components):
+        self.node = node
+
+        parent_cc = None
+        if node.data["labels"]:
+            parent_cc = components[iter(node.data["labels"]).next()]
+
+        blocks = collections.OrderedDict()
+        self.parent_block = []
+        self.free = []
+        for child in node.children:
+            if not child.data["labels"]:
+                self.free.append(child)
+                continue
+            cc = components[iter(child.data["labels"]).next()]
+            if cc == parent_cc:
+                self.parent_block.append(child)
+            else:
+                blocks.setdefault(cc, []).append(child)
+        self.blocks = [tuple(block) for block in blocks.itervalues()]
+
+        # block sizes index the compositions
+        self.sizes = sorted(set(len(block) for block in self.blocks))
+        self._size_index = dict((size, i) for i, size in enumerate(self.sizes))
+        self._closed = {}
+        self._sets = {}
+
+    def __iter__(self):
+        """Iterate through the component-preserving resolutions"""
+        if self.parent_block:
+            bases = self._iter_skeletons(self.parent_block, self.blocks,
+                                         top=True)
+        elif self.blocks:
+            bases = self._iter_closed(self.blocks)
+        else:
+            bases = [None]
+        for base in bases:
+            for tree in _iter_free(base, self.free):
+                yield tree
+
+    def count(self):
+        """Returns the number of component-preserving resolutions"""
+        return self._count_base() * _free_factor(
+            len(self.node.children) - len(self.free), len(self.free))
+
+    def sample(self, rand=random):
+        """Returns a uniformly random component-preserving resolution"""
+        if self.parent_block:
+            comp = self._composition(self.blocks)
+            x = rand.randrange(self._count_base())
+            for r in xrange(len(self.blocks) + 1):
+                weight = (count_skeletons(len(self.parent_block), r, True) *
+                          self._count_sets(comp, r))
+                if x < weight:
+                    break
+                x -= weight
+            clades = self._sample_sets(self.blocks, r, rand)
+            tree = _random_skeleton(self.parent_block, clades, rand, True)
+        elif self.blocks:
+            tree = self._sample_closed(self.blocks, rand)
+        else:
+            tree = None
+
+        for child in self.free:
+            if tree is None:
+                tree = child
+            else:
+                tree = rand.choice(list(_insertions(tree, child)))
+        return tree
+
+    #=========================================================================
+    # counting
+
+    def _count_base(self):
+        """Returns the number of resolutions without the free children"""
+        comp = self._composition(self.blocks)
+        if self.parent_block:
+            return sum(count_skeletons(len(self.parent_block), r, True) *
+                       self._count_sets(comp, r)
+                       for r in xrange(len(self.blocks) + 1))
+        elif self.blocks:
+            return self._count_closed(comp)
+        else:
+            return 1
+
+    def _composition(self, blocks):
+        """Returns the number of blocks of each size"""
+        comp = [0] * len(self.sizes)
+        for block in blocks:
+            comp[self._size_index[len(block)]] += 1
+        return tuple(comp)
+
+    def _subcompositions(self, comp):
+        """Yields (sub, ways) for the subsets of blocks holding a first block
+
+        The first block is one of the smallest blocks in comp.  ways is the
+        number of subsets of composition sub that hold it.
+        """
+        first = min(i for i, k in enumerate(comp) if k)
+        ranges = [xrange(1 if i == first else 0, k + 1)
+                  for i, k in enumerate(comp)]
+        for sub in itertools.product(*ranges):
+            ways = 1
+            for i, (k, j) in enumerate(zip(comp, sub)):
+                if i == first:
+                    ways *= choose(k - 1, j - 1)
+                else:
+                    ways *= choose(k, j)
+            yield sub, ways
+
+    def _count_closed(self, comp):
+        """Returns the number of closed clades over blocks of composition comp"""
+        if comp in self._closed:
+            return self._closed[comp]
+
+        count = 0
+        # smallest clade holding a block of each size
+        for i, k in enumerate(comp):
+            if k:
+                rest = comp[:i] + (k - 1,) + comp[i+1:]
+                count += k * sum(count_skeletons(self.sizes[i], r) *
+                                 self._count_sets(rest, r)
+                                 for r in xrange(sum(rest) + 1))
+
+        # join of two closed clades
+        for sub, ways in self._subcompositions(comp):
+            if sub != comp:
+                rest = tuple(k - j for k, j in zip(comp, sub))
+                count += (ways * self._count_closed(sub) *
+                          self._count_closed(rest))
+
+        self._closed[comp] = count
+        return count
+
+    def _count_sets(self, comp, nclades):
+        """Returns the number of sets of nclades closed clades over comp"""
+        if nclades == 0:
+            return 1 if sum(comp) == 0 else 0
+        if sum(comp) < nclades:
+            return 0
+        key = (comp, nclades)
+        if key in self._sets:
+            return self._sets[key]
+
+        # choose the clade holding the first block
+        count = 0
+        for sub, ways in self._subcompositions(comp):
+            rest = tuple(k - j for k, j in zip(comp, sub))
+            count += (ways * self._count_closed(sub) *
+                      self._count_sets(rest, nclades - 1))
+
+        self._sets[key] = count
+        return count
+
+    #=========================================================================
+    # sampling
+
+    def _sample_closed(self, blocks, rand):
+        """Returns a uniformly random closed clade over blocks"""
+        comp = self._composition(blocks)
+        x = rand.randrange(self._count_closed(comp))
+
+        for i, block in enumerate(blocks):
+            rest = blocks[:i] + blocks[i+1:]
+            rest_comp = self._composition(rest)
+            for r in xrange(len(rest) + 1):
+                weight = (count_skeletons(len(block), r) *
+                          self._count_sets(rest_comp, r))
+                if x < weight:
+                    clades = self._sample_sets(rest, r, rand)
+                    return _random_skeleton(block, clades, rand)
+                x -= weight
+
+        for sub, ways in self._subcompositions(comp):
+            if sub == comp:
+                continue
+            rest = tuple(k - j for k, j in zip(comp, sub))
+            weight = ways * self._count_closed(sub) * self._count_closed(rest)
+            if x < weight:
+                side, others = self._random_side(blocks, sub, rand)
+                return (self._sample_closed(side, rand),
+                        self._sample_closed(others, rand))
+            x -= weight
+
+        assert False, "sample out of range"
+
+    def _sample_sets(self, blocks, nclades, rand):
+        """Returns a uniformly random set of nclades closed clades"""
+        if nclades == 0:
+            return []
+        comp = self._composition(blocks)
+        x = rand.randrange(self._count_sets(comp, nclades))
+
+        for sub, ways in self._subcompositions(comp):
+            rest = tuple(k - j for k, j in zip(comp, sub))
+            weight = (ways * self._count_closed(sub) *
+                      self._count_sets(rest, nclades - 1))
+            if x < weight:
+                side, others = self._random_side(blocks, sub, rand)
+                return ([self._sample_closed(side, rand)] +
+                        self._sample_sets(others, nclades - 1, rand))
+            x -= weight
+
+        assert False, "sample out of range"
+
+    def _random_side(self, blocks, sub, rand):
+        """Split blocks into a random subset of composition sub that holds the
+        first smallest block, and the remaining blocks"""
+        first = min(xrange(len(blocks)), key=lambda i: len(blocks[i]))
+        side = [blocks[first]]
+        others = []
+        for i, size in enumerate(self.sizes):
+            group = [block for j, block in enumerate(blocks)
+                     if j != first and len(block) == size]
+            need = sub[i] - (1 if len(blocks[first]) == size else 0)
+            chosen = set(rand.sample(xrange(len(group)), need))
+            for j, block in enumerate(group):
+                (side if j in chosen else others).append(block)
+        return side, others
+
+    #=========================================================================
+    # enumeration
+
+    def _iter_closed(self, blocks):
+        """Iterate through the closed clades over blocks"""
+        for i, block in enumerate(blocks):
+            rest = blocks[:i] + blocks[i+1:]
+            for tree in self._iter_skeletons(block, rest):
+                yield tree
+
+        first = min(xrange(len(blocks)), key=lambda i: len(blocks[i]))
+        others = blocks[:first] + blocks[first+1:]
+        for size in xrange(len(others)):
+            for chosen in itertools.combinations(xrange(len(others)), size):
+                side = [blocks[first]] + [others[j] for j in chosen]
+                rest = [block for j, block in enumerate(others)
+                        if j not in chosen]
+                for tree1 in self._iter_closed(side):
+                    for tree2 in self._iter_closed(rest):
+                        yield (tree1, tree2)
+
+    def _iter_skeletons(self, block, blocks, top=False):
+        """Iterate through skeletons over a block and closed clades of blocks"""
+        for nclades in xrange(len(blocks) + 1):
+            for clades in self._iter_sets(blocks, nclades):
+                for tree in _iter_binary(list(block)):
+                    for tree2 in _iter_attach(tree, clades, clades, top):
+                        yield tree2
+
+    def _iter_sets(self, blocks, nclades):
+        """Iterate through the sets of nclades closed clades over blocks"""
+        if nclades == 0:
+            if not blocks:
+                yield []
+            return
+        if len(blocks) < nclades:
+            return
+
+        first = min(xrange(len(blocks)), key=lambda i: len(blocks[i]))
+        others = blocks[:first] + blocks[first+1:]
+        for size in xrange(len(others) + 1):
+            for chosen in itertools.combinations(xrange(len(others)), size):
+                side = [blocks[first]] + [others[j] for j in chosen]
+                rest = [block for j, block in enumerate(others)
+                        if j not in chosen]
+                for tree in self._iter_closed(side):
+                    for trees in self._iter_sets(rest, nclades - 1):
+                        yield [tree] + trees
+
+
+#=============================================================================
+# resolution trees
+
+def _insertions(tree, item, clades=(), root=True):
+    """Iterate through the trees made by joining item above each subtree
+
+    Subtrees that are in clades are kept whole and item is not joined to
+    them.  If root is False, item is not joined to the whole tree.
+    """
+    if any(tree is clade for clade in clades):
+        return
+    if root:
+        yield (tree, item)
+    if isinstance(tree, tuple):
+        left, right = tree
+        for left2 in _insertions(left, item, clades):
+            yield (left2, right)
+        for right2 in _insertions(right, item, clades):
+            yield (left, right2)
+
+
+def _iter_binary(leaves):
+    """Iterate through the binary trees over leaves"""
+    if len(leaves) == 1:
+        yield leaves[0]
+        return
+    for tree in _iter_binary(leaves[:-1]):
+        for tree2 in _insertions(tree, leaves[-1]):
+            yield tree2
+
+
+def _iter_attach(tree, pending, clades, top=False):
+    """Iterate through the ways of attaching the pending clades to tree"""
+    if not pending:
+        yield tree
+        return
+    for tree2 in _insertions(tree, pending[0], clades, top):
+        for tree3 in _iter_attach(tree2, pending[1:], clades, top):
+            yield tree3
+
+
+def _iter_free(tree, free):
+    """Iterate through the ways of inserting free children into tree"""
+    if not free:
+        yield tree
+        return
+    if tree is None:
+        trees = [free[0]]
+    else:
+        trees = _insertions(tree, free[0])
+    for tree2 in trees:
+        for tree3 in _iter_free(tree2, free[1:]):
+            yield tree3
+
+
+def _random_skeleton(leaves, clades, rand, top=False):
+    """Returns a uniformly random skeleton over leaves and clades"""
+    tree = leaves[0]
+    for leaf in leaves[1:]:
+        tree = rand.choice(list(_insertions(tree, leaf)))
+    for clade in clades:
+        tree = rand.choice(list(_insertions(tree, clade, clades, top)))
+    return tree
+
+
+def _free_factor(n, nfree):
+    """Returns the number of ways to insert nfree children into a tree of n"""
+    factor = 1
+    for i in xrange(nfree):
+        if n > 0:
+            factor *= 2 * n - 1
+        n += 1
+    return factor
+
+
+def resolve(tree, node, resolution):
+    """Replace the children of node by a resolution (nested pairs of them)"""
+    for child in node.children:
+        child.parent = None
+    node.children = []
+
+    def walk(parent, pair):
+        for item in pair:
+            if isinstance(item, tuple):
+                walk(tree.add_child(parent, tree.new_node()), item)
+            else:
+                tree.add_child(parent, item)
+    walk(node, resolution)
+
+
+def _rename(resolution, nodes):
+    """Returns resolution with its children replaced by nodes[child.name]"""
+    if isinstance(resolution, tuple):
+        return tuple(_rename(item, nodes) for item in resolution)
+    return nodes[resolution.name]
+
+
+#=============================================================================
+# trees
+
+def polytomies(tree, mapping='sli_'):
+    """Returns a Polytomy for each multifurcating node of tree
+
+    The branches of tree are labeled in place (see plctlib.create_plct).
+    """
+    groupings = plctlib.group_leaves(tree, mapping)
+    plctlib.create_plct(tree, groupings)
+    leg = plctlib.create_leg(tree, groupings, "components")
+    components = leglib.component_map(leg)
+    return [Polytomy(node, components) for node in tree.preorder()
+            if len(node.children) > 2]
+
+
+def count_resolutions(tree, mapping='sli_'):
+    """Returns the number of component-preserving binary resolutions of tree
+
+    Polytomies are resolved independently, so this is the product of their
+    counts.
+    """
+    count = 1
+    for polytomy in polytomies(tree.copy(), mapping):
+        count *= polytomy.count()
+    return count
+
+
+def sample_resolution(tree, mapping='sli_', rand=random):
+    """Returns a copy of tree with uniformly random component-preserving
+    resolutions"""
+    tree = tree.copy()
+    for polytomy in polytomies(tree, mapping):
+        resolve(tree, polytomy.node, polytomy.sample(rand))
+    return tree
+
+
+def iter_resolutions(tree, mapping='sli_'):
+    """Lazily iterate through copies of tree with each component-preserving
+    resolution"""
+    work = tree.copy()
+    for choice in _iter_product(polytomies(work, mapping)):
+        tree2 = work.copy()
+        for polytomy, resolution in choice:
+            node = tree2.nodes[polytomy.node.name]
+            resolve(tree2, node, _rename(resolution, tree2.nodes))
+        yield tree2
+
+
+def _iter_product(polytomies):
+    """Iterate through tuples of (polytomy, resolution), one per polytomy"""
+    if not polytomies:
+        yield ()
+        return
+    for resolution in polytomies[0]:
+        for rest in _iter_product(polytomies[1:]):
+            yield ((polytomies[0], resolution),) + rest
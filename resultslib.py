@@ -0,0 +1,296 @@
+# Columnar batch results
+#
+# Results of a batch feasibility run are stored as columns, one row per tree:
+#
+#   tree_id         -- int64 id of the tree
+#   name            -- tree name
+#   feasible        -- bool
+#   seconds         -- float64 time taken for the tree (nan if not timed)
+#   conflicts       -- list of conflicting components, each a list of label
+#                      ids (see plctlib.get_conflicts)
+#   branches        -- postorder index (as in arraytreelib) of each branch
+#                      annotated by plctlib.annotate
+#   reconcilable, reconcilable_cc
+#                   -- flags of those branches (1 True, 0 False, -1 unset)
+#
+# Labels are interned, and the species and locus of each label id are
+# stored with the results.  With pyarrow the results are written to a
+# Parquet file with list columns, and the label table goes into the schema
+# metadata.  Without pyarrow they are written to a NumPy .npz file.  There a
+# list column is stored as its flattened values plus offsets into them
+# ("<column>_offsets", one more than the number of lists), as in a CSR matrix.
+#
+# Columns are kept in compact typed buffers until the writer is closed.
+import array
+import json
+import time
+
+from rasmus import treelib
+import plctlib
+
+
+# flag values of branch annotations
+FLAG_UNSET = -1
+FLAG_FALSE = 0
+FLAG_TRUE = 1
+
+# rows per Parquet row group
+ROW_GROUP_SIZE = 1 << 16
+
+
+def has_pyarrow():
+    """Returns True if pyarrow (and its Parquet support) can be imported"""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def results_format(filename, format=None):
+    """Returns the format ("parquet" or "npz") for a results file"""
+    if format is None:
+        if filename.endswith(".npz"):
+            format = "npz"
+        elif filename.endswith(".parquet") or has_pyarrow():
+            format = "parquet"
+        else:
+            format = "npz"
+    if format not in ("parquet", "npz"):
+        raise Exception("results format not supported: %s" % format)
+    if format == "parquet" and not has_pyarrow():
+        raise Exception("parquet results require pyarrow")
+    return format
+
+
+class ResultsWriter(object):
+    """Collects per-tree results as columns and writes them on close
+
+    filename -- output file
+    format   -- "parquet" or "npz" (default: from the file extension, else
+                parquet if pyarrow is available)
+    """
+
+    def __init__(self, filename, format=None):
+        self.filename = filename
+        self.format = results_format(filename, format)
+
+        self.tree_ids = array.array("l")
+        self.names = []
+        self.feasible = array.array("b")
+        self.seconds = array.array("d")
+
+        self.conflicts_offsets = array.array("l", [0])
+        self.conflict_offsets = array.array("l", [0])
+        self.conflict_labels = array.array("i")
+
+        self.branches_offsets = array.array("l", [0])
+        self.branches = array.array("i")
+        self.reconcilable = array.array("b")
+        self.reconcilable_cc = array.array("b")
+
+        self.labels = []
+        self.label_ids = {}
+
+    def __len__(self):
+        """Returns the number of rows"""
+        return len(self.tree_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.close()
+
+    def label_id(self, label):
+        """Returns the id of a (species, locus) label, interning it if needed"""
+        lid = self.label_ids.get(label)
+        if lid is None:
+            lid = self.label_ids[label] = len(self.labels)
+            self.labels.append(label)
+        return lid
+
+    def add(self, tree_id, feasible, seconds=float("nan"), conflicts=(),
+            tree=None, name=None):
+        """Add the results of one tree
+
+        conflicts -- conflicting components, as from plctlib.get_conflicts
+        tree      -- the tree annotated with plctlib.annotate, to store the
+                     flags of its branches
+        """
+        self.tree_ids.append(tree_id)
+        self.names.append(tree_id if name is None else name)
+        self.feasible.append(bool(feasible))
+        self.seconds.append(seconds)
+
+        for cc in conflicts:
+            self.conflict_labels.extend(self.label_id(label) for label in cc)
+            self.conflict_offsets.append(len(self.conflict_labels))
+        self.conflicts_offsets.append(len(self.conflict_offsets) - 1)
+
+        if tree is not None:
+            for i, node in enumerate(tree.postorder()):
+                data = node.data
+                if "reconcilable_cc" in data:
+                    self.branches.append(i)
+                    self.reconcilable.append(_flag(data.get("reconcilable")))
+                    self.reconcilable_cc.append(
+                        _flag(data["reconcilable_cc"]))
+        self.branches_offsets.append(len(self.branches))
+
+    def close(self):
+        """Write the results"""
+        if self.format == "parquet":
+            self._write_parquet()
+        else:
+            self._write_npz()
+
+    def _columns(self):
+        """Returns a dict of NumPy arrays of the typed buffers"""
+        import numpy as np
+
+        def column(buf, dtype):
+            return np.frombuffer(buf, dtype=buf.typecode).astype(dtype)
+
+        return {
+            "tree_id": column(self.tree_ids, np.int64),
+            "feasible": column(self.feasible, bool),
+            "seconds": column(self.seconds, np.float64),
+            "conflicts_offsets": column(self.conflicts_offsets, np.int64),
+            "conflict_offsets": column(self.conflict_offsets, np.int64),
+            "conflict_labels": column(self.conflict_labels, np.int32),
+            "branches_offsets": column(self.branches_offsets, np.int64),
+            "branches": column(self.branches, np.int32),
+            "reconcilable": column(self.reconcilable, np.int8),
+            "reconcilable_cc": column(self.reconcilable_cc, np.int8)}
+
+    def _write_npz(self):
+        import numpy as np
+        import sharedtreelib
+
+        columns = self._columns()
+        (columns["name_kinds"], columns["name_offsets"],
+         columns["name_data"]) = sharedtreelib.pack_names(self.names)
+        columns["label_species"] = np.array(
+            [species for species, locus in self.labels], dtype=str)
+        columns["label_loci"] = np.array(
+            [locus for species, locus in self.labels], dtype=str)
+
+        out = open(self.filename, "wb")
+        np.savez(out, **columns)
+        out.close()
+
+    def _write_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = self._columns()
+
+        def lists(offsets, values):
+            return pa.ListArray.from_arrays(
+                pa.array(offsets.astype("int32")), values)
+
+        arrays = [
+            pa.array(columns["tree_id"]),
+            pa.array([str(name) for name in self.names]),
+            pa.array(columns["feasible"]),
+            pa.array(columns["seconds"]),
+            lists(columns["conflicts_offsets"],
+                  lists(columns["conflict_offsets"],
+                        pa.array(columns["conflict_labels"]))),
+            lists(columns["branches_offsets"], pa.array(columns["branches"])),
+            lists(columns["branches_offsets"],
+                  pa.array(columns["reconcilable"])),
+            lists(columns["branches_offsets"],
+                  pa.array(columns["reconcilable_cc"]))]
+        names = ["tree_id", "name", "feasible", "seconds", "conflicts",
+                 "branches", "reconcilable", "reconcilable_cc"]
+
+        table = pa.Table.from_arrays(arrays, names)
+        table = table.replace_schema_metadata(
+            {"labels": json.dumps(self.labels)})
+        pq.write_table(table, self.filename, row_group_size=ROW_GROUP_SIZE)
+
+
+def _flag(value):
+    """Returns the column value of a branch flag"""
+    if value is None:
+        return FLAG_UNSET
+    return FLAG_TRUE if value else FLAG_FALSE
+
+
+def read_results(filename, format=None):
+    """Returns (columns, labels) of a results file
+
+    columns -- a pyarrow Table for Parquet, a dict of NumPy arrays (list
+               columns flattened, see above) for .npz
+    labels  -- list of the (species, locus) of each label id
+    """
+    if results_format(filename, format) == "parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename)
+        labels = json.loads(table.schema.metadata["labels"])
+        return table, [tuple(label) for label in labels]
+
+    import numpy as np
+    import sharedtreelib
+
+    npz = np.load(filename)
+    columns = dict((key, npz[key]) for key in npz.files)
+    columns["name"] = list(sharedtreelib.NameTable(
+        columns.pop("name_kinds"), columns.pop("name_offsets"),
+        columns.pop("name_data")))
+    labels = zip(columns.pop("label_species").tolist(),
+                 columns.pop("label_loci").tolist())
+    return columns, labels
+
+
+#=============================================================================
+# batch runs
+
+def write_batch(trees, filename, mapping='sli', annotate=False, format=None,
+                dedup=True):
+    """Check the feasibility of each tree and write the results
+
+    trees    -- iterable of treelib.Trees (their branches are labeled in
+                place)
+    annotate -- also store the branch flags of plctlib.annotate
+    dedup    -- find the conflicts once per topology (see canonlib); trees
+                repeating an earlier topology reuse its conflicts
+
+    Returns the number of trees.
+    """
+    if dedup:
+        import canonlib
+
+    writer = ResultsWriter(filename, format)
+    seen = {}  # canonical hash -> conflicts
+    for i, tree in enumerate(trees):
+        start = time.time()
+        key = canonlib.canonical_hash(tree) if dedup else None
+        conflicts = seen.get(key)
+        if conflicts is None or annotate:
+            groupings = plctlib.group_leaves(tree, mapping)
+            plctlib.create_plct(tree, groupings)
+            if conflicts is None:
+                conflicts = plctlib.get_conflicts(
+                    plctlib.create_leg(tree, groupings, "components"))
+                if dedup:
+                    seen[key] = conflicts
+            if annotate:
+                plctlib.annotate(tree, conflicts)
+        seconds = time.time() - start
+
+        name = tree.name if getattr(tree, "name", None) is not None else i
+        writer.add(i, not conflicts, seconds, conflicts,
+                   tree if annotate else None, name)
+    writer.close()
+    return len(writer)
+
+
+def newick2results(infile, filename, mapping='sli', annotate=False,
+                   format=None, dedup=True):
+    """Write the results of each tree of a newick file"""
+    return write_batch(treelib.iter_trees(infile), filename, mapping,
+                       annotate, format, dedup)
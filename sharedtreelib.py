@@ -0,0 +1,209 @@
+# Shared-memory tree transport
+#
+# Pickling a treelib.Tree for a worker process copies every node, its data
+# dict and its parent links (and may hit the recursion limit on deep trees).
+# Instead, the arrays of an arraytreelib.ArrayTree and an interned name table
+# are written once into a memory-mapped file on a shared memory filesystem.
+# Workers receive only a small picklable handle and map the same pages,
+# rebuilding an ArrayTree view without copying.
+import mmap
+import os
+import tempfile
+
+import numpy as np
+
+import arraytreelib
+
+
+# directory for shared memory files (tmpfs when available)
+if os.path.isdir("/dev/shm"):
+    SHM_DIR = "/dev/shm"
+else:
+    SHM_DIR = None
+
+# alignment of each array in a shared block
+ALIGN = 8
+
+# name kinds in a name table
+NAME_STR = 0
+NAME_INT = 1
+
+
+class SharedArrays(object):
+    """A picklable handle to named numpy arrays in a shared file
+
+    fields -- list of (name, dtype, shape, offset)
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+
+    def __repr__(self):
+        return "<shared arrays %s>" % self.path
+
+    @classmethod
+    def create(cls, arrays, dir=SHM_DIR):
+        """Copy a dict of arrays into a new shared file"""
+        fields, size = layout_arrays(arrays)
+
+        fd, path = tempfile.mkstemp(prefix="tree-", suffix=".shm", dir=dir)
+        try:
+            os.ftruncate(fd, max(size, 1))
+            buf = mmap.mmap(fd, max(size, 1))
+            for name, dtype, shape, offset in fields:
+                data = np.ascontiguousarray(arrays[name]).tostring()
+                buf[offset:offset + len(data)] = data
+            buf.close()
+        finally:
+            os.close(fd)
+
+        return cls(path, fields)
+
+    def attach(self):
+        """Returns a dict of read-only array views of the shared file"""
+        with open(self.path, "rb") as infile:
+            buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        return map_arrays(buf, self.fields)
+
+    def unlink(self):
+        """Remove the shared file (attached views remain valid)"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.unlink()
+
+
+def layout_arrays(arrays):
+    """Returns (fields, size) for laying out a dict of arrays in a buffer
+
+    fields -- list of (name, dtype, shape, offset), ordered by name
+    size   -- total size of the buffer in bytes
+    """
+    fields = []
+    size = 0
+    for name in sorted(arrays):
+        array = arrays[name]
+        fields.append((name, array.dtype.str, array.shape, size))
+        size += array.nbytes
+        size += -size % ALIGN
+    return fields, size
+
+
+def map_arrays(buf, fields, base=0):
+    """Returns a dict of array views of buffer 'buf' described by fields"""
+    arrays = {}
+    for name, dtype, shape, offset in fields:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                     offset=base + offset).reshape(shape)
+    return arrays
+
+
+#=============================================================================
+# name tables
+
+class NameTable(object):
+    """A read-only list of node names stored in arrays
+
+    kinds   -- NAME_STR or NAME_INT for each name
+    offsets -- start of each name in data (length n+1)
+    data    -- uint8 array of the concatenated names
+    """
+
+    def __init__(self, kinds, offsets, data):
+        self.kinds = kinds
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        name = self.data[self.offsets[i]:self.offsets[i+1]].tostring()
+        if self.kinds[i] == NAME_INT:
+            return int(name)
+        return name
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+def pack_names(names):
+    """Returns (kinds, offsets, data) arrays for a list of names"""
+    kinds = np.zeros(len(names), dtype=np.uint8)
+    strings = []
+    for i, name in enumerate(names):
+        if isinstance(name, (int, long)):
+            kinds[i] = NAME_INT
+            name = str(name)
+        elif isinstance(name, unicode):
+            name = name.encode("utf-8")
+        strings.append(name)
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in strings], out=offsets[1:])
+    data = np.frombuffer("".join(strings), dtype=np.uint8)
+    return kinds, offsets, data
+
+
+#=============================================================================
+# shared trees
+
+def tree_arrays(atree, names=True):
+    """Returns a dict of the arrays of an ArrayTree and its name table"""
+    arrays = {"parents": atree.parents,
+              "starts": atree.starts,
+              "dists": atree.dists}
+    if names:
+        kinds, offsets, data = pack_names(atree.names)
+        arrays.update(name_kinds=kinds, name_offsets=offsets, name_data=data)
+    return arrays
+
+
+def array_tree(arrays):
+    """Returns an ArrayTree view of the arrays made by tree_arrays"""
+    if "name_kinds" in arrays:
+        names = NameTable(arrays["name_kinds"], arrays["name_offsets"],
+                          arrays["name_data"])
+    else:
+        names = None
+    return arraytreelib.ArrayTree(
+        arrays["parents"], arrays["starts"], arrays["dists"], names)
+
+
+def share_tree(atree, names=True, **extra):
+    """Copies an ArrayTree (and any extra arrays) into shared memory
+
+    Returns a SharedArrays handle.  The caller should unlink() it once the
+    workers are done.  The name table can be left out with names=False.
+    """
+    arrays = tree_arrays(atree, names)
+    for name, array in extra.iteritems():
+        assert name not in arrays, name
+        arrays[name] = array
+    return SharedArrays.create(arrays)
+
+
+# arrays already attached in this process, by path
+_attached = {}
+
+
+def attach_tree(handle):
+    """Returns (atree, arrays) for a handle made by share_tree
+
+    atree is an ArrayTree view of the shared tree and arrays holds all
+    shared arrays (including the extra ones).  Attachments are cached per
+    process, so workers map each shared file once.
+    """
+    if handle.path not in _attached:
+        arrays = handle.attach()
+        _attached.clear()
+        _attached[handle.path] = (array_tree(arrays), arrays)
+    return _attached[handle.path]
@@ -0,0 +1,289 @@
+# Streaming PLCT construction
+#
+# A tree is read from its Newick tokens without building its nodes.  The first
+# pass counts the leaves of each label.  The second keeps a stack of open
+# clades, each with the label counts of its finished children merged so far
+# (the smaller dict into the larger), dropping a label once its count reaches
+# its total.  When a clade closes (on ")"), the labels left are the ones on
+# the branch above it, and the LEG components holding them are joined.
+#
+# The labels of a finished child are in one component, and a label shared by
+# two children is in the components of both, so a clade only keeps the number
+# of its labels in each component to know which components to join.  Memory is
+# bounded by the depth of the tree times the labels open across it, plus the
+# totals and components of the labels.
+import re
+
+from rasmus import util
+
+import plctlib
+
+
+# clade markers of iter_clades (tokens never contain them as names)
+OPEN = "("
+CLOSE = ")"
+
+# characters read at a time by tokenize_newick
+CHUNK_SIZE = 1 << 16
+
+_TOKEN = re.compile(r"\[[^\]]*\]?|[();,:]|[^\s();,:\[]+")
+_SPECIAL = frozenset("();,:")
+
+
+def tokenize_newick(infile, chunk_size=CHUNK_SIZE):
+    """Iterates through the tokens of a newick stream (as
+    treelib.tokenize_newick), reading it in chunks
+
+    infile -- a string or file stream
+    """
+    if isinstance(infile, basestring):
+        chunks = iter([infile])
+    else:
+        chunks = iter(lambda: infile.read(chunk_size), "")
+
+    rest = ""
+    for chunk in chunks:
+        text = rest + chunk
+        rest = ""
+        for match in _TOKEN.finditer(text):
+            token = match.group()
+            # a word or comment at the end of the chunk may go on in the next
+            if match.end() == len(text) and (
+                    token[0] == "[" and token[-1] != "]" or
+                    token not in _SPECIAL and token[0] != "["):
+                rest = token
+                break
+            yield token
+    if rest:
+        yield rest
+
+
+def iter_clades(tokens):
+    """Iterates through the clades of the first tree of a token stream
+
+    Yields OPEN and CLOSE around each internal node and the name of each
+    leaf, in order.  Internal node names, branch lengths and comments are
+    skipped.
+    """
+    subtree = True   # a subtree comes next
+    length = False   # the next word is a branch length
+    for token in tokens:
+        if token[0] == "[":
+            continue
+        elif token == ":":
+            length = True
+            continue
+        elif token == "(":
+            yield OPEN
+            subtree = True
+        elif token == "," or token == ")":
+            if subtree:
+                yield ""
+            if token == ")":
+                yield CLOSE
+            subtree = (token == ",")
+        elif token == ";":
+            return
+        elif length:
+            pass
+        elif subtree:
+            yield token
+            subtree = False
+        length = False
+
+
+class Components(object):
+    """LEG components of labels, with the loci of each species"""
+
+    def __init__(self):
+        self.union = {}
+        self.loci = {}           # root -> species -> locus
+        self.conflicting = set() # roots of components with two loci of a species
+
+    def find(self, label):
+        """Returns the root of the component of label"""
+        union = self.union
+        parent = union.get(label, label)
+        while parent != label:
+            union[label] = grand = union.get(parent, parent)
+            label, parent = parent, grand
+        return label
+
+    def join(self, label1, label2):
+        """Joins the components of two labels
+
+        Returns True if the joined component has two loci of a species.
+        """
+        root1, root2 = self.find(label1), self.find(label2)
+        if root1 == root2:
+            return root1 in self.conflicting
+        loci1, loci2 = self._loci(root1), self._loci(root2)
+        if len(loci1) < len(loci2):
+            root1, root2, loci1, loci2 = root2, root1, loci2, loci1
+
+        self.union[root2] = root1
+        del self.loci[root2]
+        conflict = root1 in self.conflicting or root2 in self.conflicting
+        self.conflicting.discard(root2)
+        for species, locus in loci2.iteritems():
+            if loci1.setdefault(species, locus) != locus:
+                conflict = True
+        if conflict:
+            self.conflicting.add(root1)
+        return conflict
+
+    def _loci(self, root):
+        loci = self.loci.get(root)
+        if loci is None:
+            loci = self.loci[root] = {root[0]: root[1]}
+        return loci
+
+
+#=============================================================================
+# passes
+
+def count_labels(infile, mapping='sli'):
+    """Returns the number of leaves of each label of a newick stream"""
+    totals = {}
+    for name in iter_clades(tokenize_newick(infile)):
+        if name != OPEN and name != CLOSE:
+            label = plctlib.leaf_label(name, mapping)
+            totals[label] = totals.get(label, 0) + 1
+    return totals
+
+
+def iter_merges(infile, mapping='sli', totals=None, components=None):
+    """Iterates through the merges of LEG components while reading a tree
+
+    infile     -- a filename or seekable stream (read twice unless totals is
+                  given)
+    totals     -- number of leaves of each label (see count_labels)
+    components -- Components to join the labels in
+
+    Yields (label1, label2, conflict) for each pair of labels whose
+    components are joined, where conflict is True if the joined component
+    has two loci of a species.
+    """
+    if components is None:
+        components = Components()
+
+    if totals is None:
+        totals = _count_pass(infile, mapping)
+
+    # a file opened here is closed when the merges end or are abandoned
+    stream = infile
+    if isinstance(infile, basestring):
+        stream = util.open_stream(infile)
+    try:
+        find = components.find
+        stack = []
+        # open label counts, and their number in each component
+        frame = [{}, {}]
+        for name in iter_clades(tokenize_newick(stream)):
+            if name == OPEN:
+                stack.append(frame)
+                frame = [{}, {}]
+                continue
+
+            if name == CLOSE:
+                if not stack:
+                    raise Exception("unbalanced newick")
+                counts, classes = frame
+                frame = stack.pop()
+                roots = _compact(classes, find).keys()
+                for root in roots[1:]:
+                    yield roots[0], root, components.join(roots[0], root)
+                root = roots[0] if roots else None
+            else:
+                root = plctlib.leaf_label(name, mapping)
+                counts = {root: 1} if totals[root] > 1 else {}
+
+            if counts:
+                _add_counts(frame, counts, root, totals, find)
+
+        if stack:
+            raise Exception("unbalanced newick")
+    finally:
+        if stream is not infile:
+            stream.close()
+
+
+def _count_pass(infile, mapping):
+    """Returns count_labels of a filename or stream, rewinding the stream"""
+    if isinstance(infile, basestring):
+        stream = util.open_stream(infile)
+        try:
+            return count_labels(stream, mapping)
+        finally:
+            stream.close()
+    start = infile.tell()
+    totals = count_labels(infile, mapping)
+    infile.seek(start)
+    return totals
+
+
+def _add_counts(frame, counts, root, totals, find):
+    """Merge the counts of a finished child (in the component of root) into
+    the frame of its parent"""
+    big, classes = frame
+    classes[root] = classes.get(root, 0) + len(counts)
+    small = counts
+    if len(small) > len(big):
+        big, small = small, big
+        frame[0] = big
+
+    # a label in both is counted twice, and a closed label not at all
+    for label, count in small.iteritems():
+        if label in big:
+            count += big[label]
+            if count == totals[label]:
+                del big[label]
+                n = 2
+            else:
+                big[label] = count
+                n = 1
+            key = find(label)
+            classes[key] = classes.get(key, 0) - n
+        else:
+            big[label] = count
+
+    if len(classes) > 2 * len(big) + 2:
+        frame[1] = _compact(classes, find)
+
+
+def _compact(classes, find):
+    """Returns the label counts of each component with labels left"""
+    compact = {}
+    for root, n in classes.iteritems():
+        root = find(root)
+        compact[root] = compact.get(root, 0) + n
+    return dict((root, n) for root, n in compact.iteritems() if n)
+
+
+#=============================================================================
+# feasibility
+
+def is_feasible(infile, mapping='sli', totals=None):
+    """Returns True if the tree of a newick stream has no conflicts, stopping
+    at the first one"""
+    for label1, label2, conflict in iter_merges(infile, mapping, totals):
+        if conflict:
+            return False
+    return True
+
+
+def find_conflicts(infile, mapping='sli', totals=None):
+    """Returns the conflicting components of the tree of a newick stream (as
+    plctlib.find_conflicts)"""
+    if totals is None:
+        totals = _count_pass(infile, mapping)
+    components = Components()
+    for merge in iter_merges(infile, mapping, totals, components):
+        pass
+
+    ccs = {}
+    for label in totals:
+        root = components.find(label)
+        if root in components.conflicting:
+            ccs.setdefault(root, []).append(label)
+    return set(tuple(cc) for cc in ccs.itervalues())
@@ -0,0 +1,251 @@
+# Tree archives
+#
+# An indexed collection of trees in a single file:
+#
+#   header -- magic, format version, offset and size of the table of
+#             contents (struct "<4sIQQ")
+#   trees  -- one bintreelib blob per tree, 8 byte aligned
+#   toc    -- a bintreelib blob of arrays with the offset, size and name of
+#             each tree and optional cached feasibility results
+#
+# The table of contents is written last, so archives can be built in one
+# streaming pass over a newick file.  Trees are fetched in O(1) by id (or by
+# name, after a one-time index of the names) as memory-mapped ArrayTree views.
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from rasmus import treelib
+import arraytreelib
+import bintreelib
+import sharedtreelib
+
+
+MAGIC = "MTRA"
+VERSION = 1
+HEADER = struct.Struct("<4sIQQ")
+
+# cached feasibility flags
+RESULT_NONE = -1
+RESULT_INFEASIBLE = 0
+RESULT_FEASIBLE = 1
+
+
+class TreeArchive(object):
+    """A read-only, memory-mapped tree archive"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.buf = bintreelib.map_file(filename)
+
+        magic, version, toc_offset, toc_size = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise Exception("not a tree archive: %s" % filename)
+        if version != VERSION:
+            raise Exception("tree archive version not supported: %d" % version)
+
+        toc = bintreelib.unpack_arrays(self.buf, toc_offset)
+        self.offsets = toc["offsets"]
+        self.sizes = toc["sizes"]
+        self.names = sharedtreelib.NameTable(
+            toc["name_kinds"], toc["name_offsets"], toc["name_data"])
+        self.flags = toc["flags"]
+        self.conflicts = sharedtreelib.NameTable(
+            toc["conflict_kinds"], toc["conflict_offsets"],
+            toc["conflict_data"])
+        self._lookup = None
+
+    def __repr__(self):
+        return "<tree archive %s with %d trees>" % (self.filename, len(self))
+
+    def __len__(self):
+        """Returns number of trees in archive"""
+        return len(self.offsets)
+
+    def __iter__(self):
+        """Iterate through ArrayTree views of the trees"""
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, key):
+        """Returns an ArrayTree view of a tree by id or name"""
+        return bintreelib.unpack_tree(self.buf, self.offsets[self.index(key)])
+
+    def index(self, key):
+        """Returns the id of a tree given its id or name"""
+        if isinstance(key, (int, long, np.integer)):
+            return key
+        if self._lookup is None:
+            self._lookup = dict((name, i) for i, name in enumerate(self.names))
+        return self._lookup[key]
+
+    def get_tree(self, key):
+        """Returns a tree by id or name as a treelib.Tree"""
+        tree = arraytreelib.to_tree(self[key])
+        tree.name = self.names[self.index(key)]
+        return tree
+
+    def get_result(self, key):
+        """Returns the cached (flag, conflicts) of a tree or None"""
+        i = self.index(key)
+        if self.flags[i] == RESULT_NONE:
+            return None
+        return (self.flags[i] == RESULT_FEASIBLE,
+                decode_conflicts(self.conflicts[i]))
+
+    def results(self):
+        """Returns a dict of all cached results by tree id"""
+        return dict((i, self.get_result(i)) for i in xrange(len(self))
+                    if self.flags[i] != RESULT_NONE)
+
+    def slice(self, first, last):
+        """Returns (offset, size) of the bytes holding trees first..last-1"""
+        offset = int(self.offsets[first])
+        return offset, int(self.offsets[last-1] + self.sizes[last-1]) - offset
+
+
+def open_slice(filename, offsets):
+    """Map only the part of an archive holding the trees at 'offsets'
+
+    Returns ArrayTree views of the trees.  This lets a worker map its share
+    of an archive given just the file name and the offsets of its trees.
+    """
+    offsets = [int(offset) for offset in offsets]
+    start = min(offsets)
+    start -= start % mmap.ALLOCATIONGRANULARITY
+    stop = max(offsets)
+
+    with open(filename, "rb") as infile:
+        # the last blob extends past its offset; map to its end
+        infile.seek(stop)
+        head = infile.read(bintreelib.HEADER.size)
+        magic, version, headlen = bintreelib.HEADER.unpack(head)
+        infile.seek(stop)
+        stop += bintreelib.blob_size(infile.read(headlen))
+        buf = mmap.mmap(infile.fileno(), stop - start,
+                        access=mmap.ACCESS_READ, offset=start)
+
+    return [bintreelib.unpack_tree(buf, offset - start) for offset in offsets]
+
+
+#=============================================================================
+# writing archives
+
+def write_archive(filename, trees, names=None, results=None):
+    """Write an iterable of trees to a tree archive
+
+    trees   -- treelib.Trees or ArrayTrees, consumed one at a time
+    names   -- optional names of the trees (default: tree.name, else its id)
+    results -- optional dict of cached (flag, conflicts) by tree id
+    """
+    out = bintreelib.open_output(filename)
+    out.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+    pos = HEADER.size
+    pos += _pad(out, pos)
+
+    offsets = []
+    sizes = []
+    tree_names = []
+    if names is not None:
+        names = iter(names)
+
+    for i, tree in enumerate(trees):
+        if names is not None:
+            name = names.next()
+        elif getattr(tree, "name", None) is not None:
+            name = tree.name
+        else:
+            name = i
+
+        if not isinstance(tree, arraytreelib.ArrayTree):
+            tree = arraytreelib.from_tree(tree)
+        blob = bintreelib.pack_tree(tree)
+        out.write(blob)
+
+        offsets.append(pos)
+        sizes.append(len(blob))
+        tree_names.append(name)
+        pos += len(blob)
+        pos += _pad(out, pos)
+
+    _write_toc(out, pos, offsets, sizes, tree_names, results or {})
+    out.close()
+
+
+def newick2archive(infile, filename, names=None, results=None):
+    """Convert a newick file of one or more trees to a tree archive"""
+    write_archive(filename, treelib.iter_trees(infile), names, results)
+
+
+def set_results(filename, results):
+    """Update the cached (flag, conflicts) results of an archive
+
+    results -- dict of (flag, conflicts) by tree id or name.  A new table of
+               contents is appended; the trees are not rewritten.
+    """
+    archive = TreeArchive(filename)
+    merged = archive.results()
+    for key, result in results.iteritems():
+        merged[archive.index(key)] = result
+    offsets = list(archive.offsets)
+    sizes = list(archive.sizes)
+    names = list(archive.names)
+    end = len(archive.buf)
+    archive.buf.close()
+
+    out = open(filename, "r+b")
+    out.seek(end)
+    pos = end + _pad(out, end)
+    _write_toc(out, pos, offsets, sizes, names, merged)
+    out.close()
+
+
+def _write_toc(out, pos, offsets, sizes, names, results):
+    """Write the table of contents at 'pos' and update the header"""
+    flags = np.empty(len(offsets), dtype=np.int8)
+    flags.fill(RESULT_NONE)
+    conflicts = [""] * len(offsets)
+    for i, (flag, ccs) in results.iteritems():
+        flags[i] = RESULT_FEASIBLE if flag else RESULT_INFEASIBLE
+        conflicts[i] = encode_conflicts(ccs)
+
+    name_kinds, name_offsets, name_data = sharedtreelib.pack_names(names)
+    conflict_kinds, conflict_offsets, conflict_data = \
+        sharedtreelib.pack_names(conflicts)
+    blob = bintreelib.pack_arrays({
+        "offsets": np.array(offsets, dtype=np.int64),
+        "sizes": np.array(sizes, dtype=np.int64),
+        "name_kinds": name_kinds,
+        "name_offsets": name_offsets,
+        "name_data": name_data,
+        "flags": flags,
+        "conflict_kinds": conflict_kinds,
+        "conflict_offsets": conflict_offsets,
+        "conflict_data": conflict_data})
+    out.write(blob)
+
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, VERSION, pos, len(blob)))
+
+
+def _pad(out, pos):
+    """Pad the stream at 'pos' to the blob alignment, returns pad size"""
+    pad = -pos % sharedtreelib.ALIGN
+    out.write("\0" * pad)
+    return pad
+
+
+def encode_conflicts(conflicts):
+    """Encode a set of conflicting components as a JSON string"""
+    return json.dumps(sorted(sorted(list(label) for label in cc)
+                             for cc in conflicts))
+
+
+def decode_conflicts(text):
+    """Decode conflicting components from encode_conflicts"""
+    if not text:
+        return set()
+    return set(tuple(tuple(str(x) for x in label) for label in cc)
+               for cc in json.loads(text))